@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+'''
+Watch the queries and data sources managed through the ``redash`` pillar for
+changes made on the server, e.g. in the Redash UI.
+
+.. code-block:: yaml
+
+    beacons:
+      redash:
+        - interval: 300
+
+Every poll costs a page of the queries changed since the previous one, the
+data source listing and one request per managed data source. An event is
+fired once for every object that drifted from the pillar, again only when
+it changes further, with the state that brings it back in its data:
+
+.. code-block:: yaml
+
+    tag: salt/beacon/<minion>/redash/query
+    data:
+      name: Check database version
+      drift: changed
+      state: redash.query_present
+
+The ``queries`` and ``datasources`` options turn either kind off and
+``profile`` polls another instance from ``redash:profiles``.
+'''
+
+import logging
+
+import salt.utils.beacons
+
+# Define the module's virtual name
+__virtualname__ = 'redash'
+
+log = logging.getLogger(__name__)
+
+# Drift reported so far, by kind and name
+LAST_DRIFT = {}
+
+_KINDS = {
+    'datasources': ('datasource', 'redash.datasource_present'),
+    'queries': ('query', 'redash.query_present')
+}
+
+
+def __virtual__():
+    return __virtualname__
+
+
+def validate(config):
+    '''
+    Validate the beacon configuration
+    '''
+    if not isinstance(config, list):
+        return False, 'Configuration for redash beacon must be a list.'
+    config = salt.utils.beacons.list_to_dict(config)
+    for kind in _KINDS:
+        if not isinstance(config.get(kind, True), bool):
+            return False, ('Configuration for redash beacon option %s must be'
+                           ' a boolean.' % kind)
+    if not isinstance(config.get('profile', ''), str):
+        return False, ('Configuration for redash beacon option profile must'
+                       ' be a string.')
+    return True, 'Valid beacon configuration'
+
+
+def beacon(config):
+    '''
+    Report the managed queries and data sources that drifted on the server
+    '''
+    config = salt.utils.beacons.list_to_dict(config)
+    tree = dict(__salt__['pillar.get']('redash', {}))
+    for kind in _KINDS:
+        if not config.get(kind, True):
+            tree.pop(kind, None)
+    try:
+        drift = __salt__['redash.drift'](tree=tree,
+                                         profile=config.get('profile'))
+    except Exception as exc:
+        log.error('Could not poll Redash for drift: %s' % exc)
+        return []
+
+    ret = []
+    for kind, (tag, state) in _KINDS.items():
+        drifted = drift.get(kind, {})
+        reported = LAST_DRIFT.setdefault(kind, {})
+        for name in list(reported):
+            if name not in drifted:
+                del reported[name]
+        for name, details in drifted.items():
+            if reported.get(name) == details:
+                continue
+            reported[name] = details
+            ret.append({
+                'tag': tag,
+                'name': name,
+                'drift': details['drift'],
+                'state': state
+            })
+    return ret
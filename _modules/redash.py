@@ -6,126 +6,1315 @@ https://redash.io
 
 '''
 
+import asyncio
+import copy
+import functools
+import gzip
+import hashlib
 import json
 import logging
-import requests
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
 
-from salt.exceptions import CommandExecutionError
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import salt.cache
+from salt.exceptions import CommandExecutionError, SaltCacheError
 
 __virtualname__ = 'redash'
 
 log = logging.getLogger(__name__)
 
 
-def _headers():
-    api_key = __salt__['config.get']('redash:api_key')
-    return {
-        'Authorization': 'Key %s' % api_key,
-        'Content-Type': 'application/json;charset=utf-8'
+def _retry(retries, backoff_factor):
+    # Only idempotent requests are retried, so that a POST that timed out
+    # on the server side is never replayed.
+    kwargs = {
+        'total': retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': (429, 500, 502, 503, 504),
+        'raise_on_status': False,
     }
+    methods = frozenset(['GET', 'HEAD', 'DELETE'])
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=methods, **kwargs)
+
+
+def _json_dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    try:
+        return orjson.dumps(obj)
+    except TypeError:
+        # e.g. keys that are not strings
+        return _json_dumps(obj)
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+# JSON codecs installed, fastest first: (loads, dumps) working on bytes
+_CODECS = OrderedDict()
+if orjson is not None:
+    _CODECS['orjson'] = (orjson.loads, _orjson_dumps)
+if ujson is not None:
+    _CODECS['ujson'] = (ujson.loads, _ujson_dumps)
+_CODECS['json'] = (json.loads, _json_dumps)
+
+
+class _Client(object):
+    '''
+    Pooled, keep-alive HTTP client for the Redash API.
+
+    A single instance is kept in ``__context__`` so that every call made by
+    this module reuses the same connections and configuration.
+    '''
+
+    def __init__(self, api_url, api_key, pool_size=10, connect_timeout=5,
+                 read_timeout=30, retries=3, backoff_factor=0.5):
+        self.api_url = api_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': 'Key %s' % api_key,
+            'Content-Type': 'application/json;charset=utf-8',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        self.adapter = HTTPAdapter(pool_connections=pool_size,
+                                   pool_maxsize=pool_size,
+                                   max_retries=_retry(retries,
+                                                      backoff_factor))
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        url = '%s/%s' % (self.api_url, path)
+        return self.session.request(method, url, **kwargs)
+
+    def pool_stats(self):
+        connections = 0
+        served = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            served += pool.num_requests
+        return {
+            'connections': connections,
+            'requests': served,
+            'reused': served - connections
+        }
 
 
-def _url():
-    return __salt__['config.get']('redash:api_url')
+# Connection profile of the current call, None for the default one. It is
+# kept in a context variable so that worker threads started through _submit
+# inherit it.
+_PROFILE = contextvars.ContextVar('redash_profile', default=None) \
+    if contextvars is not None else None
+
+
+def _active_profile():
+    return _PROFILE.get() if _PROFILE is not None else None
+
+
+# Make the profile argument of a public function the active profile while
+# it runs. Calls without a profile keep the active one, so public functions
+# calling each other stay on the same instance.
+def _profiled(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profile = kwargs.get('profile')
+        if profile is None or _PROFILE is None:
+            return function(*args, **kwargs)
+        token = _PROFILE.set(profile)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _PROFILE.reset(token)
+    return wrapper
+
+
+# __context__ of the active profile: clients, caches and snapshots are
+# never shared between instances
+def _context():
+    profile = _active_profile()
+    if profile is None:
+        return __context__
+    return __context__.setdefault('redash.profiles', {}) \
+        .setdefault(profile, {})
+
+
+# redash:<key>, overridden by redash:profiles:<profile>:<key> for the active
+# profile
+def _config(key, default=None):
+    profile = _active_profile()
+    if profile is not None:
+        value = __salt__['config.get']('redash:profiles:%s:%s'
+                                       % (profile, key), None)
+        if value is not None:
+            return value
+    return __salt__['config.get']('redash:%s' % key, default)
+
+
+def _client():
+    if 'redash.client' not in _context():
+        profile = _active_profile()
+        if profile is not None and \
+                not __salt__['config.get']('redash:profiles:%s' % profile):
+            error = 'Redash profile %s is not configured' % profile
+            log.error(error)
+            raise CommandExecutionError(error)
+        _context()['redash.client'] = _Client(
+            api_url=_config('api_url'),
+            api_key=_config('api_key'),
+            pool_size=int(_config('pool_size', 10)),
+            connect_timeout=float(_config('connect_timeout', 5)),
+            read_timeout=float(_config('read_timeout', 30)),
+            retries=int(_config('retries', 3)),
+            backoff_factor=float(_config('backoff_factor', 0.5)))
+    return _context()['redash.client']
+
+
+class _Stats(object):
+    '''
+    Timing of every API request, grouped by method and endpoint template
+    such as ``GET groups/{id}/members``. Percentiles come from a uniform
+    sample of at most ``samples`` latencies per endpoint.
+    '''
+
+    def __init__(self, samples=1000):
+        self.lock = threading.Lock()
+        self.samples = samples
+        self.endpoints = {}
+        self.count = 0
+        self.time = 0.0
+
+    def _endpoint(self, method, path):
+        key = '%s %s' % (method, _template(path))
+        return self.endpoints.setdefault(key, {
+            'count': 0,
+            'errors': 0,
+            'bytes': 0,
+            'wire_bytes': 0,
+            'parse_time': 0.0,
+            'time': 0.0,
+            'statuses': {},
+            'latencies': []
+        })
+
+    # size is the decoded body, wire what came over the network for it
+    def record(self, method, path, status, size, elapsed, wire=None):
+        with self.lock:
+            endpoint = self._endpoint(method, path)
+            endpoint['count'] += 1
+            endpoint['bytes'] += size
+            endpoint['wire_bytes'] += size if wire is None else wire
+            endpoint['time'] += elapsed
+            self.count += 1
+            self.time += elapsed
+            # Reservoir sampling keeps the memory bounded on long runs
+            latencies = endpoint['latencies']
+            if len(latencies) < self.samples:
+                latencies.append(elapsed)
+            else:
+                slot = random.randrange(endpoint['count'])
+                if slot < self.samples:
+                    latencies[slot] = elapsed
+            # String keys, the event bus only accepts those
+            status_key = str(status)
+            endpoint['statuses'][status_key] = \
+                endpoint['statuses'].get(status_key, 0) + 1
+            if status is None or status >= 400:
+                endpoint['errors'] += 1
+
+    def parsed(self, method, path, elapsed):
+        with self.lock:
+            self._endpoint(method, path)['parse_time'] += elapsed
+
+    def summary(self):
+        endpoints = {}
+        totals = {'count': 0, 'errors': 0, 'bytes': 0, 'wire_bytes': 0,
+                  'time': 0.0, 'parse_time': 0.0}
+        with self.lock:
+            for key, endpoint in self.endpoints.items():
+                latencies = sorted(endpoint['latencies'])
+                endpoints[key] = {
+                    'count': endpoint['count'],
+                    'errors': endpoint['errors'],
+                    'bytes': endpoint['bytes'],
+                    'wire_bytes': endpoint['wire_bytes'],
+                    'statuses': dict(endpoint['statuses']),
+                    'time': round(endpoint['time'], 6),
+                    'parse_time': round(endpoint['parse_time'], 6),
+                    'p50': round(_percentile(latencies, 50), 6),
+                    'p95': round(_percentile(latencies, 95), 6)
+                }
+                for total in totals:
+                    totals[total] += endpoints[key][total]
+        totals['time'] = round(totals['time'], 6)
+        totals['parse_time'] = round(totals['parse_time'], 6)
+        return {'endpoints': endpoints, 'totals': totals}
+
+    # Request count and time, cheap enough to take around every state
+    def totals(self):
+        with self.lock:
+            return {'count': self.count, 'time': round(self.time, 6)}
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.count = 0
+            self.time = 0.0
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+# Replace the object ids of a path, e.g. groups/5/members/7 becomes
+# groups/{id}/members/{id}
+def _template(path):
+    parts = str(path).split('/')
+    for index, part in enumerate(parts):
+        # Job ids are not numeric and results come with an extension
+        id, dot, extension = part.partition('.')
+        if _to_id(id) is not None or (index == 1 and parts[0] == 'jobs'):
+            parts[index] = '{id}' + dot + extension
+    return '/'.join(parts)
+
+
+def _stats():
+    if 'redash.stats' not in _context():
+        _context()['redash.stats'] = _Stats()
+    return _context()['redash.stats']
+
+
+class _Breaker(object):
+    '''
+    Circuit breaker of the API requests made to one Redash instance.
+
+    After ``threshold`` consecutive failures (connection errors, timeouts
+    and 5xx answers) it opens and every request fails at once. Once
+    ``cooldown`` seconds have passed a single trial request goes through,
+    which closes the breaker when it succeeds and opens it again when it
+    fails. Transitions are saved with ``save`` so that the next runs start
+    from them.
+    '''
+
+    def __init__(self, threshold=5, cooldown=30, saved=None, save=None):
+        saved = saved or {}
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.save = save
+        self.consecutive = saved.get('consecutive', 0)
+        self.opened = saved.get('opened')
+        self.trips = saved.get('trips', 0)
+        self.last_error = saved.get('last_error')
+        self.trial = False
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.time() - self.opened < self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.consecutive == 0 and self.opened is None:
+                return
+            if self.opened is not None:
+                log.warning('Redash API answers again, closing the circuit'
+                            ' breaker')
+            self.consecutive = 0
+            self.opened = None
+            self.trial = False
+            self._save()
+
+    def failure(self, error):
+        with self.lock:
+            self.consecutive += 1
+            self.last_error = str(error)
+            if self.trial or (self.opened is None and self.threshold and
+                              self.consecutive >= self.threshold):
+                log.error('Opening the Redash API circuit breaker after %d'
+                          ' consecutive failures, last: %s'
+                          % (self.consecutive, self.last_error))
+                self.opened = time.time()
+                self.trial = False
+                self.trips += 1
+                self._save()
+
+    def _save(self):
+        if self.save is not None:
+            self.save({
+                'consecutive': self.consecutive,
+                'opened': self.opened,
+                'trips': self.trips,
+                'last_error': self.last_error
+            })
+
+    def status(self):
+        with self.lock:
+            if self.opened is None:
+                state = 'closed'
+                retry_in = 0.0
+            else:
+                retry_in = max(0.0, self.opened + self.cooldown - time.time())
+                state = 'half-open' if self.trial or not retry_in else 'open'
+            return {
+                'state': state,
+                'consecutive_failures': self.consecutive,
+                'threshold': self.threshold,
+                'trips': self.trips,
+                'retry_in': round(retry_in, 3),
+                'last_error': self.last_error
+            }
+
+
+def _breaker():
+    if 'redash.breaker' not in _context():
+        store = _snapshot_store()
+        bank = _snapshot_bank()
+        _context()['redash.breaker'] = _Breaker(
+            threshold=int(_config('breaker_threshold', 5)),
+            cooldown=float(_config('breaker_cooldown', 30)),
+            saved=store.fetch(bank, 'breaker'),
+            save=lambda saved: store.store(bank, 'breaker', saved))
+    return _context()['redash.breaker']
+
+
+# The JSON codec of redash:json_codec, by default the fastest one installed
+def _codec():
+    if 'redash.codec' not in _context():
+        name = _config('json_codec', 'auto')
+        if name not in _CODECS:
+            if name != 'auto':
+                log.warning('JSON codec %s is not installed, using %s'
+                            % (name, list(_CODECS)[0]))
+            name = list(_CODECS)[0]
+        _context()['redash.codec'] = _CODECS[name]
+    return _context()['redash.codec']
+
+
+# Decode a JSON body with the codec, timing it for redash.stats
+def _decode(method, path, body):
+    start = time.time()
+    try:
+        return _codec()[0](body)
+    finally:
+        _stats().parsed(method, path, time.time() - start)
+
+
+def _json(res, method, path):
+    return _decode(method, path, res.content)
+
+
+# Reason why requests would fail at once right now, or None
+def _refusal():
+    deadline = _context().get('redash.deadline')
+    if deadline is not None and time.time() >= deadline:
+        return 'The Redash time budget of %ss for this run is spent' \
+            % _config('run_budget')
+    status = _breaker().status()
+    if status['state'] == 'open':
+        return 'The Redash API circuit breaker is open after %d consecutive' \
+            ' failures (last: %s), retrying in %ss' \
+            % (status['consecutive_failures'], status['last_error'],
+               status['retry_in'])
+    return None
+
+
+# Timeouts of the next request, cut down to what is left of the budget of
+# the run. Raises when the budget is spent or the breaker is open.
+def _admit():
+    refusal = _refusal()
+    if refusal is None and not _breaker().allow():
+        refusal = 'The Redash API circuit breaker is waiting for a trial' \
+            ' request'
+    if refusal is not None:
+        log.error(refusal)
+        raise CommandExecutionError(refusal)
+    connect_timeout, read_timeout = _client().timeout
+    deadline = _context().get('redash.deadline')
+    if deadline is None:
+        return connect_timeout, read_timeout
+    left = max(deadline - time.time(), 0.001)
+    return min(connect_timeout, left), min(read_timeout, left)
+
+
+# Send a request through the pooled client, timing it for redash.stats and
+# reporting its outcome to the circuit breaker
+def _request(method, path, **kwargs):
+    kwargs['timeout'] = _admit()
+    cut = kwargs['timeout'] != _client().timeout
+    start = time.time()
+    status = None
+    size = 0
+    wire = None
+    try:
+        res = _client().request(method, path, **kwargs)
+        status = res.status_code
+        # Streamed bodies are left for the caller to read. The others were
+        # decompressed chunk by chunk while they arrived.
+        if kwargs.get('stream'):
+            size = int(res.headers.get('Content-Length') or 0)
+            wire = size
+        else:
+            size = len(res.content)
+            wire = res.raw.tell() if hasattr(res.raw, 'tell') else size
+    except requests.RequestException as exc:
+        # Running out of budget says nothing about the server
+        if not (cut and isinstance(exc, requests.Timeout)):
+            _breaker().failure(exc)
+        error = 'Redash API request %s %s failed: %s' % (method, path, exc)
+        log.error(error)
+        raise CommandExecutionError(error)
+    finally:
+        _stats().record(method, path, status, size, time.time() - start,
+                        wire)
+    if status >= 500:
+        _breaker().failure('HTTP %d from %s %s' % (status, method, path))
+    else:
+        _breaker().success()
+    return res
+
+
+class _LRUCache(object):
+    '''
+    Size-bounded LRU cache of single-object lookups.
+
+    Entries are keyed by ``(endpoint, id)``, e.g. ``('groups/{id}/members',
+    5)``, and copies are handed out so callers are free to mutate them.
+    '''
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            value = self.entries.pop(key)
+            self.entries[key] = value
+        return True, copy.deepcopy(value)
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = copy.deepcopy(value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, resource, id=None):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                endpoint, key_id = key
+                if endpoint.split('/')[0] != resource:
+                    continue
+                if id is not None and key_id != id:
+                    continue
+                del self.entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+def _cache():
+    if 'redash.cache' not in _context():
+        size = int(_config('cache_size', 1024))
+        _context()['redash.cache'] = _LRUCache(size=size)
+    return _context()['redash.cache']
+
+
+def _to_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Split a path such as groups/5/members into its endpoint and object id
+def _split_path(path):
+    parts = str(path).split('/')
+    for index, part in enumerate(parts):
+        id = _to_id(part)
+        if id is not None:
+            parts[index] = '{id}'
+            return '/'.join(parts), id
+    return path, None
+
+
+# Drop the cached lookups a write to path may have made stale
+def _invalidate(path, data=None):
+    cache = _cache()
+    parts = str(path).split('/')
+    resource = parts[0]
+    id = _to_id(parts[1]) if len(parts) > 1 else None
+    data = data or {}
+    cache.invalidate(resource, id)
+    # Refreshing a query runs it without touching its definition, only the
+    # query itself now points at a newer result
+    if resource == 'queries' and len(parts) > 2 and parts[2] == 'refresh':
+        return
+    _drop_snapshot(resource)
+    lookups = _context().get('redash.lookups', {})
+    for key in list(lookups.keys()):
+        if key[0] == resource or \
+                (key[0] == 'users' and resource == 'groups'):
+            lookups.pop(key, None)
+    if resource == 'groups' and id is not None:
+        # Users carry the ids of their groups, data sources their grants
+        _drop_snapshot('users')
+        if len(parts) == 2 or parts[2] == 'data_sources':
+            _drop_snapshot('data_sources')
+    index = _context().get('redash.memberships')
+    if index is not None:
+        index.invalidate(resource, id, sub=parts[2] if len(parts) > 2
+                         else None)
+    if resource == 'data_sources' and id is not None:
+        # Grants of this data source are listed under every group
+        cache.invalidate('groups')
+    elif resource == 'groups' and id is not None:
+        # Memberships and grants are visible from both sides
+        if len(parts) == 2:
+            cache.invalidate('users')
+            cache.invalidate('data_sources')
+        elif parts[2] == 'members':
+            user_id = _to_id(parts[3]) if len(parts) > 3 \
+                else data.get('user_id')
+            cache.invalidate('users', user_id)
+        elif parts[2] == 'data_sources':
+            ds_id = _to_id(parts[3]) if len(parts) > 3 \
+                else data.get('data_source_id')
+            cache.invalidate('data_sources', ds_id)
 
 
 # GET a result and return its JSON
 def _raw_get(path, params=None):
-    url = '%s/%s' % (_url(), path)
-    return requests.get(url, headers=_headers(), params=params).json()
+    return _json(_request('GET', path, params=params), 'GET', path)
+
+
+def _max_workers():
+    return max(1, int(_config('max_workers', 4)))
+
 
+# Salt keeps the loader dunders (__salt__, __context__, ...) in context
+# variables, which worker threads do not inherit. Every task runs in a copy
+# of the context of the thread submitting it.
+def _submit(pool, function, *args):
+    if contextvars is None:
+        return pool.submit(function, *args)
+    return pool.submit(contextvars.copy_context().run, function, *args)
 
-def _get(path, id=None):
+
+# Run function over items on a bounded thread pool, results keep their order
+def _map(function, items):
+    items = list(items)
+    if len(items) < 2:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(_max_workers(),
+                                            len(items))) as pool:
+        futures = [_submit(pool, function, item) for item in items]
+        return [future.result() for future in futures]
+
+
+# Fetch pages 2..N of a paginated collection concurrently, keeping order
+def _get_pages(path, first, page_size=None):
+    results = list(first['results'])
+    pages = -(-first['count'] // first['page_size']) if first['page_size'] \
+        else 1
+
+    def fetch(page):
+        params = {'page': page}
+        if page_size:
+            params['page_size'] = page_size
+        result = _raw_get(path, params=params)
+        if 'results' not in result:
+            raise CommandExecutionError('Server error when fetching page %d'
+                                        ' of %s: %s' %
+                                        (page, path, result.get('message')))
+        return result['results']
+
+    for page in _map(fetch, range(2, pages + 1)):
+        results.extend(page)
+    return results
+
+
+def _get(path, id=None, page_size=None):
     if id:
         path = '%s/%s' % (path, id)
-    result = _raw_get(path)
+    # Single objects are memoized, collections are always fetched
+    key = _split_path(path)
+    if key[1] is not None:
+        found, result = _cache().get(key)
+        if found:
+            log.trace('Received from cache: %s' % result)
+            return result
+    page_size = page_size or _config('page_size', None)
+    params = {'page_size': page_size} if page_size else None
+    result = _raw_get(path, params=params)
     # Processing pagination in response if necessary
     if isinstance(result, dict) and 'count' in result.keys():
-        results = []
-        current = 0
-        count = result['count']
-        page = 1
-        while current < count:
-            current = current + result['page_size']
-            results.extend(result['results'])
-            page = page + 1
-            result = _raw_get(path, params={'page': page})
-        result = results
+        result = _get_pages(path, result, page_size=page_size)
     log.trace('Received from wire: %s' % result)
+    if key[1] is not None:
+        _cache().set(key, result)
     return result
 
 
+# Yield the objects of a collection page by page, so that callers can stop
+# as soon as they found what they were looking for.
+def _iter_get(path, page_size=None, params=None):
+    page_size = page_size or _config('page_size', None)
+    page = 1
+    while True:
+        query = dict(params or {})
+        query['page'] = page
+        if page_size:
+            query['page_size'] = page_size
+        result = _raw_get(path, params=query)
+        if isinstance(result, dict) and 'message' in result:
+            raise CommandExecutionError('Server error when fetching %s: %s'
+                                        % (path, result['message']))
+        if not isinstance(result, dict):
+            # Collection without pagination
+            for item in result:
+                yield item
+            return
+        for item in result['results']:
+            yield item
+        if not result['results'] or \
+                page * result['page_size'] >= result['count']:
+            return
+        page = page + 1
+
+
+# Endpoints able to filter each collection server-side, newest first
+_SEARCH_ENDPOINTS = {
+    'users': ['users'],
+    'queries': ['queries', 'queries/search']
+}
+
+
+# Find out once whether the server filters a collection with ?q=. A probe
+# for a term nothing can match must come back empty; older Redash versions
+# either ignore the parameter or do not know the endpoint at all. Concurrent
+# callers wait for the probe instead of scanning the whole collection.
+def _search_endpoint(collection):
+    support = _context().setdefault('redash.search', {})
+    if collection in support:
+        return support[collection]
+    with _context().setdefault('redash.search_lock', threading.Lock()):
+        if collection not in support:
+            found = None
+            probe = 'redash-formula-probe-%s' % uuid.uuid4().hex
+            for endpoint in _SEARCH_ENDPOINTS.get(collection, []):
+                try:
+                    result = _raw_get(endpoint, params={'q': probe})
+                except ValueError:
+                    continue
+                if isinstance(result, dict) and 'message' in result:
+                    continue
+                if isinstance(result, dict):
+                    result = result.get('results')
+                if result == []:
+                    found = endpoint
+                    break
+            log.debug('Server-side search for %s: %s' % (collection, found))
+            support[collection] = found
+    return support[collection]
+
+
+# Yield the candidates of a collection matching term, filtered server-side
+# when supported and falling back to a scan of the whole collection.
+def _search(collection, term):
+    endpoint = _search_endpoint(collection)
+    if endpoint is None:
+        return _iter_get(collection)
+    return _iter_get(endpoint, params={'q': term})
+
+
+# The server object of a collection whose field equals value, not enhanced,
+# or None. Lookups are remembered during the run until the collection is
+# written to, so callers resolving the same name pay for it once.
+def _find(collection, field, value):
+    lookups = _context().setdefault('redash.lookups', {})
+    key = (collection, value)
+    if key not in lookups:
+        found = None
+        items = _snapshot(collection)
+        for item in items if items is not None \
+                else _search(collection, value):
+            if item[field] == value:
+                found = item
+                break
+        lookups[key] = found
+    return copy.deepcopy(lookups[key])
+
+
+# Collections kept in the persistent snapshot
+_SNAPSHOT_COLLECTIONS = ('users', 'groups', 'data_sources', 'queries')
+
+
+def _snapshot_ttl():
+    return float(_config('snapshot_ttl', 0))
+
+
+def _snapshot_store():
+    if 'redash.snapshot_store' not in _context():
+        _context()['redash.snapshot_store'] = salt.cache.factory(__opts__)
+    return _context()['redash.snapshot_store']
+
+
+# Snapshots of different Redash instances are kept apart
+def _snapshot_bank():
+    url = _client().api_url.encode('utf-8')
+    return 'redash/snapshots/%s' % hashlib.sha1(url).hexdigest()[:16]
+
+
+def _newest(items):
+    stamps = [item.get('updated_at') for item in items
+              if isinstance(item, dict) and item.get('updated_at')]
+    return max(stamps) if stamps else None
+
+
+# Find out once whether the server honours order=-updated_at on path. When
+# it ignores the parameter, both orders start with the same object.
+def _orders_by_updated_at(path):
+    support = _context().setdefault('redash.ordering', {})
+    if path not in support:
+        support[path] = False
+        newest = _raw_get(path, params={'order': '-updated_at',
+                                        'page_size': 1})
+        oldest = _raw_get(path, params={'order': 'updated_at',
+                                        'page_size': 1})
+        if isinstance(newest, dict) and isinstance(oldest, dict) and \
+                newest.get('count', 0) > 1 and \
+                newest.get('results') and oldest.get('results'):
+            first = newest['results'][0]
+            last = oldest['results'][0]
+            support[path] = first['id'] != last['id'] and \
+                first.get('updated_at', '') >= last.get('updated_at', '')
+    return support[path]
+
+
+# GET a whole collection, keeping the validators of the first page. With
+# the validators of a stored copy as headers, None means it is unchanged.
+def _fetch_collection(path, headers=None):
+    page_size = _config('page_size', None)
+    params = {'page_size': page_size} if page_size else None
+    res = _request('GET', path, params=params, headers=headers)
+    if headers and res.status_code == 304:
+        return None
+    result = _json(res, 'GET', path)
+    if isinstance(result, dict) and 'message' in result:
+        raise CommandExecutionError('Server error when fetching %s: %s'
+                                    % (path, result['message']))
+    if isinstance(result, dict) and 'count' in result.keys():
+        result = _get_pages(path, result, page_size=page_size)
+    return {
+        'data': result,
+        'count': len(result),
+        'updated_at': _newest(result),
+        'etag': res.headers.get('ETag'),
+        'last_modified': res.headers.get('Last-Modified')
+    }
+
+
+# Check a stored snapshot against the server, returning it when unchanged,
+# the new copy when a conditional GET already brought it, or None when it
+# has to be downloaded again
+def _revalidate(path, entry):
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    if headers:
+        return _fetch_collection(path, headers=headers) or entry
+    if not entry.get('updated_at') or not _orders_by_updated_at(path):
+        return None
+    # Unchanged when nothing was added, removed or updated since
+    newest = _raw_get(path, params={'order': '-updated_at', 'page_size': 1})
+    if newest.get('count') == entry['count'] and \
+            _newest(newest.get('results', [])) == entry['updated_at']:
+        return entry
+    return None
+
+
+# Return a snapshot fresh within redash:snapshot_ttl, or None, without
+# making any request
+def _snapshot(path):
+    ttl = _snapshot_ttl()
+    if not ttl or path not in _SNAPSHOT_COLLECTIONS:
+        return None
+    loaded = _context().setdefault('redash.snapshots', {})
+    if path not in loaded:
+        loaded[path] = _snapshot_store().fetch(_snapshot_bank(), path) or {}
+    entry = loaded[path]
+    if entry and time.time() - entry['stored'] < ttl:
+        return copy.deepcopy(entry['data'])
+    return None
+
+
+# GET a whole collection through the persistent snapshot: served from it
+# while fresh, revalidated once stale and only downloaded again if changed
+def _collection(path):
+    if not _snapshot_ttl() or path not in _SNAPSHOT_COLLECTIONS:
+        return _get(path)
+    data = _snapshot(path)
+    if data is not None:
+        return data
+    entry = _context()['redash.snapshots'][path]
+    if entry:
+        entry = _revalidate(path, entry)
+    if not entry:
+        entry = _fetch_collection(path)
+    # Details kept along are only trusted while the snapshot is fresh
+    entry.pop('details', None)
+    entry['stored'] = time.time()
+    _snapshot_store().store(_snapshot_bank(), path, entry)
+    _context()['redash.snapshots'][path] = entry
+    return copy.deepcopy(entry['data'])
+
+
+# Concurrent writers drop snapshots at the same time, and the localfs cache
+# fails to flush a file another thread has just removed
+_SNAPSHOT_FLUSH_LOCK = threading.Lock()
+
+
+def _drop_snapshot(path):
+    if not _snapshot_ttl():
+        return
+    _context().setdefault('redash.snapshots', {}).pop(path, None)
+    with _SNAPSHOT_FLUSH_LOCK:
+        try:
+            _snapshot_store().flush(_snapshot_bank(), path)
+        except SaltCacheError as exc:
+            log.debug('Could not drop the snapshot of %s: %s' % (path, exc))
+
+
+# GET several paths concurrently, results are returned in order
+def _fetch_many(paths):
+    paths = list(paths)
+    if len(paths) > 1 and _engine() == 'async':
+        return _async_fetch_many(paths)
+    return _map(_get, paths)
+
+
+def _engine():
+    engine = _config('engine', 'sync')
+    if engine == 'async' and httpx is None and aiohttp is None:
+        log.warning('redash:engine is async but neither httpx nor aiohttp '
+                    'is installed, falling back to the sync engine')
+        return 'sync'
+    return engine
+
+
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+# GET every path on one asyncio event loop, at most limit at a time. Returns
+# (status, body, elapsed, error, wire bytes) tuples in the order of paths.
+async def _async_get_many(client, paths, limit, timeout):
+    semaphore = asyncio.Semaphore(limit)
+    headers = dict(client.session.headers)
+
+    async def fetch(get, path):
+        async with semaphore:
+            start = time.time()
+            for attempt in range(client.retries + 1):
+                try:
+                    status, body, wire = await get('%s/%s' % (
+                        client.api_url, path))
+                except Exception as exc:
+                    return None, b'', time.time() - start, exc, 0
+                if status not in _RETRY_STATUSES or \
+                        attempt == client.retries:
+                    break
+                await asyncio.sleep(client.backoff_factor * (2 ** attempt))
+            return status, body, time.time() - start, None, wire
+
+    if httpx is not None:
+        timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        limits = httpx.Limits(max_connections=limit,
+                              max_keepalive_connections=limit)
+        async with httpx.AsyncClient(headers=headers, timeout=timeout,
+                                     limits=limits) as session:
+            async def get(url):
+                res = await session.get(url)
+                return res.status_code, res.content, \
+                    res.num_bytes_downloaded
+            return await asyncio.gather(*[fetch(get, path)
+                                          for path in paths])
+
+    timeout = aiohttp.ClientTimeout(sock_connect=timeout[0],
+                                    sock_read=timeout[1])
+    connector = aiohttp.TCPConnector(limit=limit)
+    async with aiohttp.ClientSession(headers=headers, timeout=timeout,
+                                     connector=connector) as session:
+        async def get(url):
+            async with session.get(url) as res:
+                body = await res.read()
+                return res.status, body, \
+                    int(res.headers.get('Content-Length') or len(body))
+        return await asyncio.gather(*[fetch(get, path) for path in paths])
+
+
+# Run a coroutine to completion from synchronous code. When this thread
+# already runs an event loop (e.g. inside the minion) a helper thread gets
+# its own loop instead.
+def _run_async(coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return _submit(pool, asyncio.run, coroutine).result()
+
+
+# Same as _fetch_many on the sync engine, with the requests that are not
+# answered by the cache sent concurrently from an asyncio event loop.
+def _async_fetch_many(paths):
+    results = [None] * len(paths)
+    missing = []
+    for position, path in enumerate(paths):
+        key = _split_path(path)
+        found, result = _cache().get(key) if key[1] is not None \
+            else (False, None)
+        if found:
+            results[position] = result
+        else:
+            missing.append(position)
+    if not missing:
+        return results
+    limit = int(_config('async_concurrency', 16))
+    responses = _run_async(_async_get_many(
+        _client(), [paths[position] for position in missing], max(1, limit),
+        _admit()))
+    for position, response in zip(missing, responses):
+        path = paths[position]
+        status, body, elapsed, error, wire = response
+        _stats().record('GET', path, status, len(body), elapsed, wire)
+        if error is not None or status >= 500:
+            _breaker().failure(error or 'HTTP %d from GET %s'
+                               % (status, path))
+        else:
+            _breaker().success()
+        if error is not None:
+            raise CommandExecutionError('Error when fetching %s: %s' %
+                                        (path, error))
+        result = _decode('GET', path, body)
+        if isinstance(result, dict) and 'count' in result.keys():
+            result = _get_pages(path, result)
+        key = _split_path(path)
+        if key[1] is not None:
+            _cache().set(key, result)
+        results[position] = result
+    return results
+
+
+class _MembershipIndex(object):
+    '''
+    In-memory view of the group memberships and data source grants.
+
+    Answers user -> groups, group -> members, group -> data sources and
+    data source -> groups without further HTTP calls. Writes mark the
+    touched groups as stale so that only those are fetched again.
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.listed = False
+        self.groups = {}
+        self.members = {}
+        self.grants = {}
+        self.user_groups = {}
+        self.ds_groups = {}
+        self.stale = set()
+
+    def set_groups(self, groups):
+        with self.lock:
+            self.groups = dict((group['id'], group) for group in groups)
+            for gid in list(self.members.keys()):
+                if gid not in self.groups:
+                    self.set_group(gid, [], [])
+                    del self.members[gid]
+                    del self.grants[gid]
+            self.listed = True
+
+    def pending(self, gids=None):
+        with self.lock:
+            if gids is None:
+                gids = self.groups.keys()
+            return sorted(gid for gid in gids if gid in self.groups and
+                          (gid not in self.members or gid in self.stale))
+
+    def set_group(self, gid, members, datasources):
+        with self.lock:
+            self.set_members(gid, [(member['id'], member['email'])
+                                   for member in members])
+            self.set_grants(gid, [(ds['id'], ds['name'], ds['view_only'])
+                                  for ds in datasources])
+
+    # The setters below also record the outcome of writes, which leave the
+    # group fresh without reading it back
+    def set_members(self, gid, members):
+        with self.lock:
+            for uid in self.user_groups:
+                self.user_groups[uid].discard(gid)
+            self.members[gid] = list(members)
+            for uid, email in self.members[gid]:
+                self.user_groups.setdefault(uid, set()).add(gid)
+            self.stale.discard(gid)
+
+    def set_grants(self, gid, grants):
+        with self.lock:
+            for ds_id in self.ds_groups:
+                self.ds_groups[ds_id].discard(gid)
+            self.grants[gid] = list(grants)
+            for ds_id, ds_name, view_only in self.grants[gid]:
+                self.ds_groups.setdefault(ds_id, set()).add(gid)
+            self.stale.discard(gid)
+
+    # A group created right after the groups were listed, the only one the
+    # list misses
+    def add_group(self, group):
+        with self.lock:
+            self.listed = True
+            self.groups[group['id']] = group
+            self.set_group(group['id'], [], [])
+
+    def invalidate(self, resource, id=None, sub=None):
+        with self.lock:
+            if resource == 'groups':
+                if id is None or sub is None:
+                    # A group was created, renamed or removed
+                    self.listed = False
+                if id is not None:
+                    self.stale.add(id)
+            elif resource == 'data_sources' and id is not None:
+                self.stale.update(self.ds_groups.get(id, ()))
+            elif resource == 'users' and id is not None:
+                self.stale.update(self.user_groups.get(id, ()))
+
+    def group_id(self, name):
+        for gid, group in self.groups.items():
+            if group['name'] == name:
+                return gid
+        return None
+
+    def group_names(self, gids):
+        gids = [_to_id(gid) for gid in gids]
+        return [self.groups[gid]['name'] for gid in sorted(gids)
+                if gid in self.groups]
+
+    def member_ids(self, gid):
+        return dict((email, uid) for uid, email in self.members.get(gid, []))
+
+    def group_members(self, gid):
+        return [email for uid, email in self.members.get(gid, [])]
+
+    def group_datasources(self, gid):
+        return dict((ds_name, {'view_only': view_only})
+                    for ds_id, ds_name, view_only in self.grants.get(gid, []))
+
+    def group(self, gid):
+        group = copy.deepcopy(self.groups[gid])
+        group['members'] = self.group_members(gid)
+        group['datasources'] = self.group_datasources(gid)
+        name = group.pop('name')
+        return name, group
+
+
+# Return the membership index, loading the members and data sources of the
+# given groups (all of them by default) concurrently when they are missing
+# or stale. Group names only need the group list.
+def _memberships(gids=None):
+    index = _context().get('redash.memberships')
+    if index is None:
+        index = _context().setdefault('redash.memberships',
+                                      _MembershipIndex())
+    with index.lock:
+        if not index.listed:
+            index.set_groups(_collection('groups'))
+        pending = index.pending(gids)
+        if pending:
+            paths = []
+            for gid in pending:
+                paths.append('groups/%d/members' % gid)
+                paths.append('groups/%d/data_sources' % gid)
+            results = _fetch_many(paths)
+            for position, gid in enumerate(pending):
+                members = results[2 * position]
+                datasources = results[2 * position + 1]
+                # The group may have been removed in the meantime
+                if isinstance(members, dict):
+                    members = []
+                if isinstance(datasources, dict):
+                    datasources = []
+                index.set_group(gid, members, datasources)
+    return index
+
+
+# Run several writes concurrently, reporting every failure at once
+def _apply_many(calls):
+    errors = []
+    if not calls:
+        return errors
+    with ThreadPoolExecutor(max_workers=min(_max_workers(),
+                                            len(calls))) as pool:
+        futures = [_submit(pool, function, *args)
+                   for function, args in calls]
+        for future in futures:
+            try:
+                future.result()
+            except CommandExecutionError as exc:
+                errors.append(str(exc))
+    if errors:
+        raise CommandExecutionError('; '.join(errors))
+
+
 # POST a request and return its JSON
 def _post(path, params=None, data=None):
-    url = '%s/%s' % (_url(), path)
-    res = requests.post(url, headers=_headers(), params=params,
-                        data=json.dumps(data))
-    content = res.json()
+    res = _request('POST', path, params=params, data=_codec()[1](data))
+    _invalidate(path, data)
+    content = _json(res, 'POST', path)
 
     if res.status_code != 200:
         raise CommandExecutionError('Server error when processing command: %s'
                                     % content['message'])
 
-    return res.json()
+    _merge_query_write(path, content)
+    return content
 
 
 # DELETE a request and return its JSON
 def _delete(path, params=None):
-    url = '%s/%s' % (_url(), path)
-    res = requests.delete(url, headers=_headers(), params=params)
+    res = _request('DELETE', path, params=params)
+    _invalidate(path)
     log.trace('DELETE Status code: %s' % res.status_code)
     log.trace('DELETE Content: %s' % res.content)
     content = ''
     if res.status_code not in [200, 204]:
-        content = res.json()
+        content = _json(res, 'DELETE', path)
         raise CommandExecutionError('Server error when processing command: %s'
                                     % content['message'])
+    _merge_query_write(path)
     return content
 
 
 def _enhance_user(user):
-    groups = []
-    for group in user['groups']:
-        log.debug('Fetching more info for group %d' % group)
-        # Groups will always come as a hash with the group name as index
-        for group in list_groups(id=group):
-            groups.append(group)
+    groups = _memberships(gids=[]).group_names(user['groups'])
     log.debug('Collected groups: %s' % groups)
     user['groups'] = groups
     email = user.pop('email')
     return email, user
 
 
-def list_users(id=None, email=None):
+@_profiled
+def list_users(id=None, email=None, profile=None):
     all_users = {}
-    result = _get('users')
     if email:
-        for user in result:
-            if user['email'] == email:
-                name, info = _enhance_user(user)
-                all_users[name] = info
-                break
+        user = _find('users', 'email', email)
+        if user is not None:
+            name, info = _enhance_user(user)
+            all_users[name] = info
     elif id:
-        for user in result:
-            if user['id'] == id:
-                name, info = _enhance_user(user)
-                all_users[name] = info
-                break
-        if not len(all_users.keys()):
+        user = _get('users', id=id)
+        if 'message' in user:
             msg = 'Could not find user with id %d' % id
             log.error(msg)
             raise CommandExecutionError(msg)
+        name, info = _enhance_user(user)
+        all_users[name] = info
     else:
-        for user in result:
+        for user in _collection('users'):
             name, info = _enhance_user(user)
             all_users[name] = info
     return all_users
 
 
-def add_user(email, name):
+@_profiled
+def add_user(email, name, profile=None):
     ret = {}
-    users = list_users(email=email)
-    if email in users.keys():
+    if _find('users', 'email', email) is not None:
         error = 'User %s already exists' % name
         log.error(error)
         raise CommandExecutionError(error)
@@ -140,48 +1329,64 @@ def add_user(email, name):
     return ret
 
 
-def alter_user(email, name):
+@_profiled
+def alter_user(email, name, id=None, profile=None):
     ret = {}
-    users = list_users(email=email)
-    if email not in users.keys():
-        error = 'User %s does not exist' % name
-        log.error(error)
-        raise CommandExecutionError(error)
-    user = users[email]
-    user['email'] = email
+    if id is None:
+        user = _find('users', 'email', email)
+        if user is None:
+            error = 'User %s does not exist' % name
+            log.error(error)
+            raise CommandExecutionError(error)
+        id = user['id']
     payload = {
         'name': name
     }
-    new_user = _post('users/%d' % user['id'], data=payload)
+    new_user = _post('users/%d' % id, data=payload)
     name, details = _enhance_user(new_user)
     ret[name] = details
     return ret
 
 
+# Details of data sources, which their listing lacks. While the data_sources
+# snapshot is fresh they are kept in it, so they are only fetched once.
+def _datasource_details(ids):
+    ids = list(ids)
+    entry = _context().get('redash.snapshots', {}).get('data_sources') \
+        if _snapshot('data_sources') is not None else None
+    details = entry.setdefault('details', {}) if entry else {}
+    missing = [id for id in ids if str(id) not in details]
+    if missing:
+        fetched = _fetch_many(['data_sources/%d' % id for id in missing])
+        for id, full_ds in zip(missing, fetched):
+            details[str(id)] = full_ds
+        if entry:
+            _snapshot_store().store(_snapshot_bank(), 'data_sources', entry)
+    return [copy.deepcopy(details[str(id)]) for id in ids]
+
+
 def _enhance_ds(ds):
     log.debug('Enhancing datasource: %s' % ds)
-    full_ds = _get('data_sources', id=ds['id'])
+    full_ds = _datasource_details([ds['id']])[0]
     ds_name = full_ds.pop('name')
-    groups = []
-    for group_id in full_ds['groups']:
-        group = list_groups(id=group_id)
-        if len(group):
-            for group_name in group:
-                groups.append(group_name)
-    full_ds['groups'] = groups
+    full_ds['groups'] = _memberships(gids=[]).group_names(full_ds['groups'])
     return ds_name, full_ds
 
 
-def list_datasources(id=None, name=None):
+@_profiled
+def list_datasources(id=None, name=None, profile=None):
     all_ds = {}
     if not name:
         log.debug('Searching datasource by id: %s' % id)
-        data_sources = _get('data_sources', id=id)
+        data_sources = _get('data_sources', id=id) if id \
+            else _collection('data_sources')
         log.debug('Found datasources: %s' % data_sources)
         if type(data_sources) == list:
             log.debug('Received list of datasources')
             # Redash will send us a simplified list of each data source,
             # but we want to output a more detailed list indexed by name.
+            # The details of all of them are fetched concurrently first.
+            _datasource_details([ds['id'] for ds in data_sources])
             for simple_ds in data_sources:
                 name, full_ds = _enhance_ds(simple_ds)
                 all_ds[name] = full_ds
@@ -199,17 +1404,15 @@ def list_datasources(id=None, name=None):
                 all_ds[name] = full_ds
     else:
         log.debug('Searching datasource by name: %s' % name)
-        # get all datasources
-        data_sources = _get('data_sources')
-        for ds in data_sources:
-            if ds['name'] == name:
-                name, full_ds = _enhance_ds(ds)
-                all_ds[name] = full_ds
-                break
+        ds = _find('data_sources', 'name', name)
+        if ds is not None:
+            name, full_ds = _enhance_ds(ds)
+            all_ds[name] = full_ds
     return all_ds
 
 
-def add_datasource(name, type, options):
+@_profiled
+def add_datasource(name, type, options, profile=None):
     ds = {
         'name': name,
         'type': type,
@@ -218,7 +1421,8 @@ def add_datasource(name, type, options):
     return _post('data_sources', data=ds)
 
 
-def alter_datasource(id, name, type, options):
+@_profiled
+def alter_datasource(id, name, type, options, profile=None):
     ds = {
         'name': name,
         'type': type,
@@ -227,7 +1431,8 @@ def alter_datasource(id, name, type, options):
     return _post('data_sources/%d' % id, data=ds)
 
 
-def remove_datasource(id=None, name=None):
+@_profiled
+def remove_datasource(id=None, name=None, profile=None):
     ret = {
         'removed': []
     }
@@ -244,88 +1449,191 @@ def remove_datasource(id=None, name=None):
         return ret
 
 
-def _enhance_query(query):
+# Names of the data sources by id, from the plain listing
+def _datasource_names():
+    return dict((ds['id'], ds['name'])
+                for ds in _collection('data_sources'))
+
+
+def _enhance_query(query, ds_names):
     log.debug('Enhancing query: %s' % query)
-    dsrcs = list_datasources(id=query.pop('data_source_id'))
-    query['datasource'] = dsrcs.keys()[0]
+    # Queries may have no data source at all
+    query['datasource'] = ds_names.get(query.pop('data_source_id', None))
+    name = query.pop('name')
+    return name, query
+
+
+# Shape a query returned by a write like list_queries does, with the name of
+# its data source that the caller already knows
+def _written_query(query, datasource):
+    query.pop('data_source_id', None)
+    query['datasource'] = datasource
     name = query.pop('name')
     return name, query
 
 
-def list_queries(id=None, name=None):
+@_profiled
+def list_queries(id=None, name=None, profile=None):
     all_queries = {}
     if not name:
         log.debug('Searching queries by id: %s' % id)
-        queries = _get('queries', id=id)
+        queries = _get('queries', id=id) if id \
+            else _collection('queries')
         # In case we go straight for an id we won't have a list.
         if type(queries) is not list:
             queries = [queries]
+        ds_names = _datasource_names()
         # Ordering queries by name in the returning hash
         for query in queries:
-            name, details = _enhance_query(query)
+            name, details = _enhance_query(query, ds_names)
             all_queries[name] = details
     else:
         log.debug('Searching queries by name: %s' % name)
-        queries = _get('queries')
-        for query in queries:
-            if query['name'] == name:
-                name, details = _enhance_query(query)
-                all_queries[name] = details
+        query = _find_query(name)
+        if query is not None:
+            name, details = _enhance_query(query, _datasource_names())
+            all_queries[name] = details
     return all_queries
 
 
+# The server object of a query by name, not enhanced
+def _find_query(name):
+    return _find('queries', 'name', name)
+
+
+# The id of a data source by name, from the plain listing
+def _datasource_id(name):
+    ds = _find('data_sources', 'name', name)
+    if ds is None:
+        error = 'Datasource %s does not exist' % name
+        log.error(error)
+        raise CommandExecutionError(error)
+    return ds['id']
+
+
+# Fingerprint of a query definition, insensitive to SQL whitespace and to
+# the order of the options. The data source is given by id when compared
+# with the server and by name when it cannot be resolved, as in manifests.
+def _query_fingerprint(datasource, description, query, options, schedule,
+                       publish):
+    definition = {
+        'datasource': datasource,
+        'description': description,
+        'query': ' '.join((query or '').split()),
+        'options': options or {},
+        'schedule': str(schedule),
+        'publish': bool(publish)
+    }
+    return hashlib.sha256(json.dumps(definition, sort_keys=True)
+                          .encode('utf-8')).hexdigest()
+
+
+# Fingerprint of a query object of the server
+def _server_fingerprint(query):
+    return _query_fingerprint(query.get('data_source_id'),
+                              query.get('description'), query.get('query'),
+                              query.get('options'), query.get('schedule'),
+                              not query.get('is_draft'))
+
+
+@_profiled
+def query_fingerprint(datasource, description, query, options=None,
+                      schedule=None, publish=True, profile=None):
+    '''
+    Return the fingerprint of a query definition, the one the incremental
+    store, upload manifests and drift detection compare.
+    '''
+    return _query_fingerprint(datasource, description, query, options,
+                              schedule, publish)
+
+
+@_profiled
+def query_matches(name, datasource, description, query, options={},
+                  schedule=None, publish=True, profile=None):
+    '''
+    Tell whether query ``name`` exists and matches the given definition by
+    comparing fingerprints, without enhancing the server objects.
+    '''
+    current = _find_query(name)
+    if current is None:
+        return False
+    ds = _find('data_sources', 'name', datasource)
+    if ds is None:
+        return False
+    desired = _query_fingerprint(ds['id'], description, query, options,
+                                 schedule, publish)
+    existing = _server_fingerprint(current)
+    log.debug('Fingerprints of query %s: %s - %s'
+              % (name, desired, existing))
+    return desired == existing
+
+
+@_profiled
 def add_query(name, datasource, description, query, options={},
-              schedule=None, publish=True):
+              schedule=None, publish=True, datasource_id=None, profile=None):
     ret = {}
-    queries = list_queries(name=name)
-    if name in queries.keys():
+    if _find_query(name) is not None:
         error = 'Query %s already exists' % name
         log.error(error)
         raise CommandExecutionError(error)
 
-    datasource = list_datasources(name=datasource)[datasource]
+    if datasource_id is None:
+        datasource_id = _datasource_id(datasource)
+    new_query = _create_query(name, datasource_id, description, query,
+                              options, schedule, publish)
+    name, details = _written_query(new_query, datasource)
+    ret[name] = details
+    return ret
+
+
+# Create a query known to be missing, returning the server object
+def _create_query(name, datasource_id, description, query, options,
+                  schedule, publish):
     query = {
         'name': name,
-        'data_source_id': datasource['id'],
+        'data_source_id': datasource_id,
         'description': description,
         'options': options,
         'query': query,
-        'schedule': schedule
+        'schedule': schedule,
+        'is_draft': not publish
     }
     log.debug('Asking server to save query: %s' % query)
     new_query = _post('queries', data=query)
-    # The following operations require a live query
-    if publish or schedule:
+    # Redash creates every query as a draft and may drop other fields, which
+    # then take a second request on the live query
+    data = {}
+    if publish and new_query.get('is_draft', True):
+        data['is_draft'] = False
+    if schedule and str(new_query.get('schedule')) != str(schedule):
+        data['schedule'] = schedule
+    if data:
         id = new_query['id']
-        data = {}
-        if publish:
-            data['is_draft'] = False
-        if schedule:
-            data['schedule'] = schedule
         log.debug('Updating the query %d with extra parameters: %s'
                   % (id, data))
-        # Refreshing information
         new_query = _post('queries/%d' % id, data=data)
         log.debug('Query published successfully')
-
-    name, details = _enhance_query(new_query)
-    ret[name] = details
-    return ret
+    return new_query
 
 
+@_profiled
 def alter_query(name, datasource, description, query, options={},
-                schedule=None, publish=True):
+                schedule=None, publish=True, id=None, datasource_id=None,
+                profile=None):
     ret = {}
-    queries = list_queries(name=name)
-    if name not in queries.keys():
-        error = 'Query %s does not exist' % name
-        log.error(error)
-        raise CommandExecutionError(error)
-
-    datasource = list_datasources(name=datasource)[datasource]
+    if id is None:
+        current = _find_query(name)
+        if current is None:
+            error = 'Query %s does not exist' % name
+            log.error(error)
+            raise CommandExecutionError(error)
+        id = current['id']
+
+    if datasource_id is None:
+        datasource_id = _datasource_id(datasource)
     query = {
         'name': name,
-        'data_source_id': datasource['id'],
+        'data_source_id': datasource_id,
         'description': description,
         'options': options,
         'query': query,
@@ -333,14 +1641,15 @@ def alter_query(name, datasource, description, query, options={},
         'is_draft': not publish
     }
     log.debug('Asking server to save query: %s' % query)
-    new_query = _post('queries/%d' % queries[name]['id'], data=query)
+    new_query = _post('queries/%d' % id, data=query)
 
-    name, details = _enhance_query(new_query)
+    name, details = _written_query(new_query, datasource)
     ret[name] = details
     return ret
 
 
-def archive_query(name):
+@_profiled
+def archive_query(name, profile=None):
     ret = {"archived": {}}
     queries = list_queries(name=name)
     if name not in queries.keys():
@@ -352,71 +1661,637 @@ def archive_query(name):
     return ret
 
 
+# Pages of queries ordered by updated_at, newest first, until the watermark
+# is passed. Returns the queries changed since and the current count.
+def _queries_changed_since(watermark):
+    changed = []
+    page = 1
+    page_size = _config('page_size', None) or 100
+    while True:
+        result = _raw_get('queries', params={'order': '-updated_at',
+                                             'page': page,
+                                             'page_size': page_size})
+        if 'results' not in result:
+            raise CommandExecutionError('Server error when fetching queries:'
+                                        ' %s' % result.get('message'))
+        for query in result['results']:
+            if query['updated_at'] < watermark:
+                return changed, result['count']
+            changed.append(query)
+        if not result['results'] or \
+                page * result['page_size'] >= result['count']:
+            return changed, result['count']
+        page = page + 1
+
+
+# Local copy of every query, kept in salt.cache and brought up to date
+# incrementally once per run. Ids are strings so the copy serializes as is.
+# Servers unable to order queries by updated_at, as Redash itself, cannot
+# tell what changed: the copy is then read again on every run.
+def _query_store():
+    if 'redash.query_store' in _context():
+        return _context()['redash.query_store']
+    store = _snapshot_store().fetch(_snapshot_bank(), 'query_store') or {}
+    previous = store.get('watermark')
+    # Whether the server honours the ordering is kept along with the copy
+    ordered = store.get('ordered')
+    if store and previous and ordered:
+        changed, count = _queries_changed_since(previous)
+        log.debug('%d queries changed since %s' % (len(changed), previous))
+        for query in changed:
+            store['queries'][str(query['id'])] = query
+        if count != len(store['queries']):
+            # Archived queries vanish from the listing, start over
+            log.debug('Query count differs, reloading all queries')
+            store = {}
+    elif store:
+        log.debug('Queries cannot be ordered by update, reloading them')
+        store = {}
+    if not store:
+        if ordered is None:
+            ordered = _orders_by_updated_at('queries')
+        store = {
+            'queries': dict((str(query['id']), query)
+                            for query in _collection('queries')),
+            'ordered': ordered
+        }
+    store['watermark'] = _newest(store['queries'].values())
+    store['previous'] = previous
+    _snapshot_store().store(_snapshot_bank(), 'query_store', store)
+    _context()['redash.query_store'] = store
+    return store
+
+
+# Keep the local copy in line with our own writes. The watermark is left
+# alone so that changes made by others in the meantime are still picked up.
+def _merge_query_write(path, content=None):
+    store = _context().get('redash.query_store')
+    parts = str(path).split('/')
+    if store is None or parts[0] != 'queries' or len(parts) > 2:
+        return
+    if content is None:
+        store['queries'].pop(parts[1], None)
+    elif isinstance(content, dict) and 'id' in content:
+        store['queries'][str(content['id'])] = copy.deepcopy(content)
+
+
+def _stored_query(name):
+    for query in _query_store()['queries'].values():
+        if query['name'] == name:
+            return query
+    return None
+
+
+@_profiled
+def list_changed_queries(since=None, profile=None):
+    '''
+    List the queries changed since the ``since`` timestamp, by default since
+    the previous call, from the incrementally updated local copy.
+    '''
+    all_queries = {}
+    store = _query_store()
+    since = since or store.get('previous')
+    ds_names = _datasource_names()
+    for query in store['queries'].values():
+        if since and query['updated_at'] < since:
+            continue
+        name, details = _enhance_query(copy.deepcopy(query), ds_names)
+        all_queries[name] = details
+    return all_queries
+
+
+def _applied_queries():
+    if 'redash.query_applied' not in _context():
+        _context()['redash.query_applied'] = _snapshot_store().fetch(
+            _snapshot_bank(), 'query_applied') or {}
+    return _context()['redash.query_applied']
+
+
+@_profiled
+def query_unchanged(name, digest, profile=None):
+    '''
+    Tell whether query ``name`` was last applied with ``digest`` and nobody
+    has changed it on the server since, without per-query requests.
+    '''
+    query = _stored_query(name)
+    applied = _applied_queries().get(name)
+    return bool(query and applied and applied['hash'] == digest and
+                applied['id'] == query['id'] and
+                applied['updated_at'] == query['updated_at'])
+
+
+@_profiled
+def remember_query(name, digest, profile=None):
+    '''
+    Record that query ``name`` now matches ``digest`` on the server.
+    '''
+    query = _stored_query(name)
+    if query is None:
+        return False
+    _applied_queries()[name] = {
+        'id': query['id'],
+        'updated_at': query['updated_at'],
+        'hash': digest
+    }
+    _snapshot_store().store(_snapshot_bank(), 'query_applied',
+                            _applied_queries())
+    return True
+
+
+# Key of the manifest of a source in the snapshot bank
+def _manifest_key(source):
+    return 'manifest-%s' % hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+# Create or update one query, unless the server already holds it
+def _upload_query(name, definition, current, ds_id):
+    args = (name, definition['datasource'], definition.get('description'),
+            definition['query'], definition.get('options') or {},
+            definition.get('schedule'), definition.get('publish', True))
+    if current is None:
+        _create_query(name, ds_id, *args[2:])
+        return 'created'
+    if _query_fingerprint(ds_id, *args[2:]) == _server_fingerprint(current):
+        return 'unchanged'
+    alter_query(*args, id=current['id'], datasource_id=ds_id)
+    return 'updated'
+
+
+@_profiled
+def upload_queries(queries, source=None, concurrency=None, force=False,
+                   test=False, profile=None):
+    '''
+    Create or update the queries of ``queries``, a mapping of names to
+    definitions like those of the ``redash:queries`` pillar, at most
+    ``concurrency`` (``redash:upload_concurrency``) at a time.
+
+    With ``source`` the hashes of the definitions applied successfully are
+    kept as its manifest, and definitions unchanged since the last call are
+    skipped without any request unless ``force`` is set.
+    '''
+    ret = {
+        'created': [],
+        'updated': [],
+        'unchanged': [],
+        'failed': {}
+    }
+    manifest = {}
+    if source is not None and not force:
+        manifest = _snapshot_store().fetch(
+            _snapshot_bank(), _manifest_key(source)) or {}
+    # Fingerprints by data source name, ids are only known by the server
+    hashes = dict((name, _query_fingerprint(
+        definition.get('datasource'), definition.get('description'),
+        definition.get('query'), definition.get('options'),
+        definition.get('schedule'), definition.get('publish', True)))
+        for name, definition in queries.items())
+    pending = sorted(name for name in queries
+                     if manifest.get(name) != hashes[name])
+    ret['unchanged'] = sorted(name for name in queries
+                              if name not in pending)
+    log.debug('%d of %d queries changed since the last upload'
+              % (len(pending), len(queries)))
+
+    # Every lookup is done before the first write, from a single read of the
+    # queries when there are several
+    if len(pending) > 1:
+        listed = dict((query['name'], query)
+                      for query in _collection('queries'))
+        currents = dict((name, listed.get(name)) for name in pending)
+    else:
+        currents = dict((name, _find_query(name)) for name in pending)
+    ds_ids = {}
+    for name in pending:
+        datasource = queries[name].get('datasource')
+        if datasource in ds_ids:
+            continue
+        try:
+            ds_ids[datasource] = _datasource_id(datasource)
+        except CommandExecutionError as exc:
+            ds_ids[datasource] = exc
+    uploads = []
+    for name in pending:
+        ds_id = ds_ids[queries[name].get('datasource')]
+        if isinstance(ds_id, CommandExecutionError):
+            ret['failed'][name] = str(ds_id)
+        elif test:
+            ret['created' if currents[name] is None
+                else 'updated'].append(name)
+        else:
+            uploads.append((name, ds_id))
+    if test:
+        return ret
+
+    if concurrency is None:
+        concurrency = _config('upload_concurrency', 4)
+    with ThreadPoolExecutor(max_workers=max(1, min(int(concurrency),
+                                                   len(uploads) or 1))) \
+            as pool:
+        futures = [(name, _submit(pool, _upload_query, name, queries[name],
+                                  currents[name], ds_id))
+                   for name, ds_id in uploads]
+        for name, future in futures:
+            try:
+                action = future.result()
+            except CommandExecutionError as exc:
+                ret['failed'][name] = str(exc)
+                continue
+            ret[action].append(name)
+            manifest[name] = hashes[name]
+
+    if source is not None:
+        # Queries no longer defined are forgotten, not archived
+        manifest = dict((name, digest) for name, digest in manifest.items()
+                        if name in queries)
+        _snapshot_store().store(_snapshot_bank(), _manifest_key(source),
+                                manifest)
+    for action in ('created', 'updated', 'unchanged'):
+        ret[action].sort()
+    return ret
+
+
+# Redash job statuses
+_JOB_STATUSES = {
+    1: 'pending',
+    2: 'started',
+    3: 'success',
+    4: 'failure',
+    5: 'cancelled'
+}
+
+# Longest wait between two polls of a refresh job, in seconds
+_REFRESH_MAX_INTERVAL = 10
+
+
+# Queries selected by name, name prefix or data source name
+def _select_queries(names=None, prefix=None, datasource=None):
+    if isinstance(names, str):
+        names = [names]
+    ds_id = None
+    if datasource:
+        for ds in _collection('data_sources'):
+            if ds['name'] == datasource:
+                ds_id = ds['id']
+        if ds_id is None:
+            error = 'Datasource %s does not exist' % datasource
+            log.error(error)
+            raise CommandExecutionError(error)
+    selected = []
+    for query in _collection('queries'):
+        if names is not None and query['name'] not in names:
+            continue
+        if prefix and not query['name'].startswith(prefix):
+            continue
+        if ds_id is not None and query['data_source_id'] != ds_id:
+            continue
+        selected.append(query)
+    missing = set(names or []) - set(query['name'] for query in selected)
+    if missing:
+        error = 'Queries %s do not exist' % ', '.join(sorted(missing))
+        log.error(error)
+        raise CommandExecutionError(error)
+    return selected
+
+
+# Interleave the queries of the different data sources, so that the workers
+# are not all waiting on the cap of the same one
+def _interleave(queries):
+    by_ds = OrderedDict()
+    for query in queries:
+        by_ds.setdefault(query['data_source_id'], []).append(query)
+    ordered = []
+    while by_ds:
+        for ds_id in list(by_ds):
+            ordered.append(by_ds[ds_id].pop(0))
+            if not by_ds[ds_id]:
+                del by_ds[ds_id]
+    return ordered
+
+
+# Trigger a refresh and poll its job with backoff until it is done
+def _refresh_query(query, limits, timeout, interval):
+    start = time.time()
+    with limits[query['data_source_id']]:
+        try:
+            job = _post('queries/%d/refresh' % query['id'])['job']
+            delay = interval
+            while job['status'] in (1, 2):
+                if time.time() - start > timeout:
+                    return {'status': 'timeout',
+                            'duration': time.time() - start,
+                            'job': job['id']}
+                time.sleep(delay)
+                delay = min(delay * 2, _REFRESH_MAX_INTERVAL)
+                res = _raw_get('jobs/%s' % job['id'])
+                if 'job' not in res:
+                    raise CommandExecutionError(
+                        'Server error when polling job %s: %s'
+                        % (job['id'], res.get('message')))
+                job = res['job']
+        except CommandExecutionError as exc:
+            log.error('Could not refresh query %s: %s' % (query['name'], exc))
+            return {'status': 'error', 'duration': time.time() - start,
+                    'error': str(exc)}
+    ret = {
+        'status': _JOB_STATUSES.get(job['status'], str(job['status'])),
+        'duration': time.time() - start,
+        'job': job['id'],
+        'query_result_id': job.get('query_result_id')
+    }
+    if job.get('error'):
+        ret['error'] = job['error']
+    return ret
+
+
+@_profiled
+def refresh_queries(names=None, prefix=None, datasource=None,
+                    concurrency=None, per_datasource=None, timeout=None,
+                    test=False, profile=None):
+    '''
+    Refresh the queries given by ``names``, by name ``prefix`` or bound to
+    ``datasource``, at most ``concurrency`` at a time and ``per_datasource``
+    at a time against the same data source, and wait for their jobs.
+    Returns the status and duration of every refresh by query name. With
+    ``test=True`` the selected queries are only listed.
+    '''
+    queries = _select_queries(names=names, prefix=prefix,
+                              datasource=datasource)
+    if test:
+        return dict((query['name'], {'status': 'pending'})
+                    for query in queries)
+    concurrency = concurrency or _config('refresh_concurrency', 4)
+    per_datasource = per_datasource or _config('refresh_per_datasource', 2)
+    timeout = timeout or _config('refresh_timeout', 600)
+    interval = _config('refresh_poll_interval', 1.0)
+    limits = dict((query['data_source_id'],
+                   threading.BoundedSemaphore(int(per_datasource)))
+                  for query in queries)
+    queries = _interleave(queries)
+    ret = {}
+    if not queries:
+        return ret
+    with ThreadPoolExecutor(max_workers=min(int(concurrency),
+                                            len(queries))) as pool:
+        futures = [(query['name'],
+                    _submit(pool, _refresh_query, query, limits,
+                            float(timeout), float(interval)))
+                   for query in queries]
+        for name, future in futures:
+            ret[name] = future.result()
+    return ret
+
+
+# Formats query results can be downloaded in
+_RESULT_FORMATS = ('csv', 'json')
+
+# Bytes read from the response and hashed at a time
+_CHUNK_SIZE = 65536
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Id of the latest result of a query, which changes on every refresh and is
+# therefore always read from the server rather than from a snapshot
+def _latest_result_id(name):
+    query = _find_query(name)
+    if query is None:
+        error = 'Query %s does not exist' % name
+        log.error(error)
+        raise CommandExecutionError(error)
+    query = _raw_get('queries/%d' % query['id'])
+    result_id = query.get('latest_query_data_id')
+    if not result_id:
+        error = 'Query %s has no result yet' % name
+        log.error(error)
+        raise CommandExecutionError(error)
+    return result_id
+
+
+@_profiled
+def get_query_result(name, profile=None):
+    '''
+    Return the id, retrieval time, column names and rows of the latest
+    result of query ``name``.
+    '''
+    result_id = _latest_result_id(name)
+    result = _raw_get('query_results/%d.json' % result_id)
+    if 'query_result' not in result:
+        raise CommandExecutionError('Server error when fetching result %d:'
+                                    ' %s' % (result_id,
+                                             result.get('message')))
+    result = result['query_result']
+    return {
+        'result_id': result_id,
+        'retrieved_at': result.get('retrieved_at'),
+        'columns': [column['name'] for column in result['data']['columns']],
+        'rows': result['data']['rows']
+    }
+
+
+# What was last fetched to every file, kept in salt.cache
+def _fetched_results():
+    if 'redash.fetched' not in _context():
+        _context()['redash.fetched'] = _snapshot_store().fetch(
+            _snapshot_bank(), 'fetched_results') or {}
+    return _context()['redash.fetched']
+
+
+# Mode bits, uid and gid asked for a result file, -1 where left alone
+def _file_perms(mode, user, group):
+    uid = gid = -1
+    if user is not None:
+        uid = __salt__['file.user_to_uid'](user)
+        if uid == '':
+            error = 'User %s does not exist' % user
+            log.error(error)
+            raise CommandExecutionError(error)
+    if group is not None:
+        gid = __salt__['file.group_to_gid'](group)
+        if gid == '':
+            error = 'Group %s does not exist' % group
+            log.error(error)
+            raise CommandExecutionError(error)
+    mode = int(str(mode), 8) if mode is not None else -1
+    return mode, int(uid), int(gid)
+
+
+# Give path the requested mode and owner, telling whether it had to change.
+# With test=True nothing is changed.
+def _set_perms(path, perms, test=False):
+    mode, uid, gid = perms
+    stat = os.stat(path)
+    chmod = mode != -1 and stat.st_mode & 0o7777 != mode
+    chown = (uid != -1 and stat.st_uid != uid) or \
+        (gid != -1 and stat.st_gid != gid)
+    if not test:
+        if chmod:
+            os.chmod(path, mode)
+        if chown:
+            os.chown(path, uid, gid)
+    return chmod or chown
+
+
+# Stream a query result to path through a temporary file in the same
+# directory, compressing it on the way when asked. The file gets its mode
+# and owner before it replaces path.
+def _download_result(result_id, format, path, compress, perms):
+    res = _request('GET', 'query_results/%d.%s' % (result_id, format),
+                   stream=True)
+    size = 0
+    try:
+        if res.status_code != 200:
+            raise CommandExecutionError('Server error when fetching result'
+                                        ' %d: %s' % (result_id, res.text))
+        handle, partial = tempfile.mkstemp(
+            dir=os.path.dirname(path) or '.',
+            prefix='.%s.' % os.path.basename(path))
+        try:
+            with os.fdopen(handle, 'wb') as raw:
+                output = gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) \
+                    if compress else raw
+                try:
+                    for chunk in res.iter_content(chunk_size=_CHUNK_SIZE):
+                        size = size + len(chunk)
+                        output.write(chunk)
+                finally:
+                    if compress:
+                        output.close()
+            _set_perms(partial, perms)
+            os.replace(partial, path)
+        except Exception:
+            os.remove(partial)
+            raise
+    finally:
+        res.close()
+    return size
+
+
+@_profiled
+def fetch_query_result(name, path, format='csv', compress=False,
+                       force=False, test=False, mode=None, user=None,
+                       group=None, profile=None):
+    '''
+    Download the latest result of query ``name`` to ``path`` as ``csv`` or
+    ``json``, gzip-compressed if ``compress`` is set. The body is streamed to
+    disk in chunks. Nothing is downloaded when the file still holds the same
+    result, unless ``force`` is set. With ``test=True`` only whether it
+    would be downloaded is reported.
+
+    The file gets the octal ``mode`` and the ``user`` and ``group`` given,
+    it is only readable by its owner otherwise.
+    '''
+    if format not in _RESULT_FORMATS:
+        error = 'Unsupported result format %s' % format
+        log.error(error)
+        raise CommandExecutionError(error)
+    perms = _file_perms(mode, user, group)
+    result_id = _latest_result_id(name)
+
+    ret = {
+        'path': path,
+        'result_id': result_id,
+        'format': format,
+        'compressed': bool(compress),
+        'changed': True,
+        'downloaded': True
+    }
+    fetched = _fetched_results().get(path)
+    if not force and fetched and os.path.isfile(path) and \
+            fetched['result_id'] == result_id and \
+            fetched['format'] == format and \
+            fetched['compressed'] == bool(compress) and \
+            fetched['sha256'] == _file_sha256(path):
+        ret.update(fetched)
+        # Only the mode or owner of the file may still have to change
+        ret['downloaded'] = False
+        ret['changed'] = _set_perms(path, perms, test=test)
+        return ret
+    if test:
+        return ret
+
+    ret['bytes'] = _download_result(result_id, format, path, compress,
+                                    perms)
+    ret['sha256'] = _file_sha256(path)
+    _fetched_results()[path] = dict((key, ret[key]) for key in
+                                    ('result_id', 'format', 'compressed',
+                                     'bytes', 'sha256'))
+    _snapshot_store().store(_snapshot_bank(), 'fetched_results',
+                            _fetched_results())
+    return ret
+
+
 def _enhance_group(group):
     log.debug('Enhancing group: %s' % group)
-    # Retrieving members list
-    all_members = []
-    for member in _get('groups/%d/members' % group['id']):
-        all_members.append(member['email'])
-    group['members'] = all_members
-    # Retrieving datasources list
-    all_ds = {}
-    for ds in _get('groups/%d/data_sources' % group['id']):
-        all_ds[ds['name']] = {
-            'view_only': ds['view_only']
-        }
-    group['datasources'] = all_ds
+    index = _memberships(gids=[group['id']])
+    group['members'] = index.group_members(group['id'])
+    group['datasources'] = index.group_datasources(group['id'])
     name = group.pop('name')
     return name, group
 
 
-def list_groups(name=None, id=None):
+@_profiled
+def list_groups(name=None, id=None, profile=None):
     all_groups = {}
+    index = _memberships(gids=[])
     if not name:
         log.debug('Searching groups by id: %s' % id)
-        groups = _get('groups', id=id)
-        # In case we go straight for an id we won't have a list.
-        if type(groups) is not list:
-            # We got a single result, let us verify that it isn't an error.
-            # We need to do this because redash keeps memberships lingering in
-            # the database after a group is removed.
-            if 'message' in groups:
-                log.info('No group found for id: %s' % groups)
-                groups = []
-            else:
-                groups = [groups]
-        # Ordering queries by name in the returning hash
-        for group in groups:
-            name, details = _enhance_group(group)
-            all_groups[name] = details
+        if not id:
+            gids = sorted(index.groups.keys())
+        elif id in index.groups:
+            gids = [id]
+        else:
+            # Redash keeps memberships lingering in the database after a
+            # group is removed, so unknown ids are expected here.
+            log.info('No group found for id: %s' % id)
+            gids = []
     else:
         log.debug('Searching groups by name: %s' % name)
-        groups = _get('groups')
-        for group in groups:
-            if group['name'] == name:
-                name, details = _enhance_group(group)
-                all_groups[name] = details
+        gid = index.group_id(name)
+        gids = [gid] if gid is not None else []
+    _memberships(gids=gids)
+    for gid in gids:
+        name, details = index.group(gid)
+        all_groups[name] = details
     return all_groups
 
 
-def add_group(name):
+@_profiled
+def add_group(name, profile=None):
     ret = {}
-    groups = list_groups(name=name)
-    if name in groups.keys():
+    index = _memberships(gids=[])
+    if index.group_id(name) is not None:
         error = 'Group %s already exists' % name
         log.error(error)
         raise CommandExecutionError(error)
     group = {
         'name': name,
     }
-    # Create new group
+    # Create new group, which has neither members nor data sources yet
     new_group = _post('groups', data=group)
-    name, details = _enhance_group(new_group)
+    index.add_group(new_group)
+    name, details = index.group(new_group['id'])
     ret[name] = details
     return ret
 
 
-def add_group_member(name, member):
+# A user to add to or remove from a group, by email
+def _member(email):
+    user = _find('users', 'email', email)
+    if user is None:
+        error = 'User %s does not exist' % email
+        log.error(error)
+        raise CommandExecutionError(error)
+    return user
+
+
+@_profiled
+def add_group_member(name, member, profile=None):
     ret = {}
     groups = list_groups(name=name)
     if name not in groups.keys():
@@ -431,16 +2306,20 @@ def add_group_member(name, member):
         log.warning('%s is already a member of group %s' % (member, name))
     else:
         log.debug('Adding user %s to group' % member)
-        member_info = list_users(email=member)[member]
+        member_info = _member(member)
         log.debug('Found member info: %s' % member_info)
         payload = {'user_id': member_info['id']}
         _post('groups/%d/members' % group['id'], data=payload)
+        index = _memberships(gids=[])
+        index.set_members(group['id'], index.members[group['id']] +
+                          [(member_info['id'], member)])
     name, details = _enhance_group(group)
     ret[name] = details
     return ret
 
 
-def remove_group_member(name, member):
+@_profiled
+def remove_group_member(name, member, profile=None):
     ret = {}
     groups = list_groups(name=name)
     if name not in groups.keys():
@@ -455,15 +2334,21 @@ def remove_group_member(name, member):
         log.warning('%s is already not a member of group %s' %
                     (member, name))
     else:
-        member_info = list_users(email=member)[member]
+        member_info = _member(member)
         log.debug('Found member info: %s' % member_info)
         _delete('groups/%d/members/%d' % (group['id'], member_info['id']))
+        index = _memberships(gids=[])
+        index.set_members(group['id'],
+                          [(uid, email) for uid, email
+                           in index.members[group['id']]
+                           if uid != member_info['id']])
     name, details = _enhance_group(group)
     ret[name] = details
     return ret
 
 
-def add_group_datasource(name, datasource):
+@_profiled
+def add_group_datasource(name, datasource, profile=None):
     ret = {}
     groups = list_groups(name=name)
     if name not in groups.keys():
@@ -473,9 +2358,12 @@ def add_group_datasource(name, datasource):
     group = groups[name]
     group['name'] = name
     if datasource not in group['datasources'].keys():
-        ds = list_datasources(name=datasource)[datasource]
-        payload = {'data_source_id': ds['id']}
+        ds_id = _datasource_id(datasource)
+        payload = {'data_source_id': ds_id}
         _post('groups/%d/data_sources' % group['id'], data=payload)
+        index = _memberships(gids=[])
+        index.set_grants(group['id'], index.grants[group['id']] +
+                         [(ds_id, datasource, False)])
     else:
         log.warning('Datasource %s already accessible to group' % datasource)
     name, details = _enhance_group(group)
@@ -483,7 +2371,8 @@ def add_group_datasource(name, datasource):
     return ret
 
 
-def remove_group_datasource(name, datasource):
+@_profiled
+def remove_group_datasource(name, datasource, profile=None):
     ret = {}
     groups = list_groups(name=name)
     if name not in groups.keys():
@@ -493,8 +2382,12 @@ def remove_group_datasource(name, datasource):
     group = groups[name]
     group['name'] = name
     if datasource in group['datasources'].keys():
-        ds = list_datasources(name=datasource)[datasource]
-        _delete('groups/%d/data_sources/%d' % (group['id'], ds['id']))
+        ds_id = _datasource_id(datasource)
+        _delete('groups/%d/data_sources/%d' % (group['id'], ds_id))
+        index = _memberships(gids=[])
+        index.set_grants(group['id'],
+                         [grant for grant in index.grants[group['id']]
+                          if grant[0] != ds_id])
     else:
         log.warning('Datasource %s already not accessible to group' %
                     datasource)
@@ -503,7 +2396,8 @@ def remove_group_datasource(name, datasource):
     return ret
 
 
-def alter_group_datasource(name, datasource, view_only=False):
+@_profiled
+def alter_group_datasource(name, datasource, view_only=False, profile=None):
     ret = {}
     groups = list_groups(name=name)
     if name not in groups.keys():
@@ -516,10 +2410,15 @@ def alter_group_datasource(name, datasource, view_only=False):
         current_view = group['datasources'][datasource].get('view_only', False)
         if current_view != view_only:
             log.warning('Changing datasource visibility')
-            ds = list_datasources(name=datasource)[datasource]
+            ds_id = _datasource_id(datasource)
             payload = {'view_only': view_only}
-            _post('groups/%d/data_sources/%d' % (group['id'], ds['id']),
+            _post('groups/%d/data_sources/%d' % (group['id'], ds_id),
                   data=payload)
+            index = _memberships(gids=[])
+            index.set_grants(group['id'],
+                             [(grant[0], grant[1], view_only)
+                              if grant[0] == ds_id else grant
+                              for grant in index.grants[group['id']]])
     else:
         raise CommandExecutionError('Datasource %s not accessible to group' %
                                     datasource)
@@ -528,7 +2427,101 @@ def alter_group_datasource(name, datasource, view_only=False):
     return ret
 
 
-def remove_group(name):
+def _group_for_update(name):
+    index = _memberships(gids=[])
+    gid = index.group_id(name)
+    if gid is None:
+        error = 'Group %s does not exist' % name
+        log.error(error)
+        raise CommandExecutionError(error)
+    return _memberships(gids=[gid]), gid
+
+
+@_profiled
+def set_group_members(name, members, profile=None):
+    ret = {}
+    index, gid = _group_for_update(name)
+    current = index.member_ids(gid)
+    members_add = [member for member in members if member not in current]
+    members_remove = [member for member in current if member not in members]
+    log.debug('Members to add: %s' % members_add)
+    log.debug('Members to remove: %s' % members_remove)
+    calls = []
+    if members_add:
+        # Resolving every new member with one read of the users
+        user_ids = dict((user['email'], user['id'])
+                        for user in _collection('users'))
+        missing = [member for member in members_add
+                   if member not in user_ids]
+        if missing:
+            error = 'Users %s do not exist' % ', '.join(missing)
+            log.error(error)
+            raise CommandExecutionError(error)
+        for member in members_add:
+            calls.append((_post, ('groups/%d/members' % gid, None,
+                                  {'user_id': user_ids[member]})))
+    for member in members_remove:
+        calls.append((_delete, ('groups/%d/members/%d' %
+                                (gid, current[member]),)))
+    _apply_many(calls)
+    # The members are known now, without reading them back
+    ids = dict(current)
+    if members_add:
+        ids.update(user_ids)
+    index.set_members(gid, [(ids[member], member)
+                            for member in OrderedDict.fromkeys(members)])
+    name, details = list_groups(name=name).popitem()
+    ret[name] = details
+    return ret
+
+
+def _grant_datasource(gid, ds_id, view_only):
+    _post('groups/%d/data_sources' % gid, data={'data_source_id': ds_id})
+    if view_only:
+        _post('groups/%d/data_sources/%d' % (gid, ds_id),
+              data={'view_only': view_only})
+
+
+@_profiled
+def set_group_datasources(name, datasources, profile=None):
+    ret = {}
+    index, gid = _group_for_update(name)
+    current = index.group_datasources(gid)
+    wanted = dict((ds, bool((options or {}).get('view_only', False)))
+                  for ds, options in (datasources or {}).items())
+    ds_ids = dict((ds['name'], ds['id'])
+                  for ds in _collection('data_sources'))
+    missing = [ds for ds in wanted if ds not in ds_ids]
+    if missing:
+        error = 'Datasources %s do not exist' % ', '.join(missing)
+        log.error(error)
+        raise CommandExecutionError(error)
+    calls = []
+    for ds, view_only in wanted.items():
+        if ds not in current:
+            calls.append((_grant_datasource, (gid, ds_ids[ds], view_only)))
+        elif current[ds].get('view_only', False) != view_only:
+            calls.append((_post, ('groups/%d/data_sources/%d' %
+                                  (gid, ds_ids[ds]), None,
+                                  {'view_only': view_only})))
+    for ds in current:
+        if ds not in wanted and ds in ds_ids:
+            calls.append((_delete, ('groups/%d/data_sources/%d' %
+                                    (gid, ds_ids[ds]),)))
+    log.debug('Datasource changes for group %s: %d' % (name, len(calls)))
+    grants = [(ds_ids[ds], ds, view_only) for ds, view_only in wanted.items()]
+    # Grants of data sources unknown to the listing cannot be revoked
+    grants.extend(grant for grant in index.grants.get(gid, [])
+                  if grant[1] not in ds_ids)
+    _apply_many(calls)
+    index.set_grants(gid, grants)
+    name, details = list_groups(name=name).popitem()
+    ret[name] = details
+    return ret
+
+
+@_profiled
+def remove_group(name, profile=None):
     ret = {'removed': {}}
     groups = list_groups(name=name)
     if name not in groups.keys():
@@ -540,9 +2533,521 @@ def remove_group(name):
     return ret
 
 
-def list_dashboards(id=None):
+# Options the server never returns as set, they are left out of comparisons
+_SECRET_OPTIONS = ('password',)
+
+
+def _options_equal(desired, current):
+    desired = dict((k, v) for k, v in (desired or {}).items()
+                   if k not in _SECRET_OPTIONS)
+    current = dict((k, v) for k, v in (current or {}).items()
+                   if k not in _SECRET_OPTIONS)
+    return desired == current
+
+
+def datasource_options_equal(desired, current):
+    '''
+    Tell whether the ``desired`` options of a data source match the
+    ``current`` ones, leaving out the secrets the server does not return.
+    '''
+    return _options_equal(desired, current)
+
+
+def _desired_queries(queries):
+    desired = {}
+    for query, properties in (queries or {}).items():
+        properties = properties or {}
+        name = query
+        if properties.get('namespaced', False):
+            name = '%s - %s' % (properties['datasource'], query)
+        desired[name] = properties
+    return desired
+
+
+# Fetch every collection once and index it by name. With ``kinds`` only the
+# collections needed to reconcile those parts of the tree are read.
+def _read_instance(kinds=None):
+    kinds = set(kinds or ['datasources', 'users', 'groups', 'queries'])
+    instance = {
+        'users': {},
+        'groups': {},
+        'datasources': {},
+        'queries': {}
+    }
+    if kinds & set(['users', 'groups']):
+        for user in _collection('users'):
+            instance['users'][user['email']] = user
+    if 'groups' in kinds:
+        instance['groups'] = list_groups()
+    if kinds & set(['datasources', 'groups', 'queries']):
+        for ds in _collection('data_sources'):
+            instance['datasources'][ds['name']] = ds
+    if 'queries' in kinds:
+        for query in _collection('queries'):
+            instance['queries'][query['name']] = query
+    return instance
+
+
+def _plan(tree, instance):
+    plan = []
+    datasources = tree.get('datasources') or {}
+    users = tree.get('users') or {}
+    groups = tree.get('groups') or {}
+    queries = _desired_queries(tree.get('queries'))
+
+    # Data sources are needed by groups and queries, so they come first.
+    # Removals wait until nothing refers to them anymore.
+    removed_ds = []
+    existing = []
+    for name, properties in datasources.items():
+        properties = properties or {}
+        current = instance['datasources'].get(name)
+        if properties.get('absent', False):
+            if current:
+                removed_ds.append({'type': 'datasources', 'action': 'delete',
+                                   'name': name, 'current': current})
+            continue
+        if not current:
+            plan.append({'type': 'datasources', 'action': 'create',
+                         'name': name, 'desired': properties})
+            continue
+        existing.append((name, properties))
+    # The listing lacks the options, only managed ones are detailed, all of
+    # them at once
+    details = _datasource_details(instance['datasources'][name]['id']
+                                  for name, properties in existing)
+    for (name, properties), current in zip(existing, details):
+        instance['datasources'][name] = current
+        if properties['type'] != current['type'] or \
+                not _options_equal(properties.get('options'),
+                                   current.get('options')):
+            plan.append({'type': 'datasources', 'action': 'update',
+                         'name': name, 'desired': properties,
+                         'current': current})
+
+    for email, properties in users.items():
+        properties = properties or {}
+        current = instance['users'].get(email)
+        if not current:
+            plan.append({'type': 'users', 'action': 'create', 'name': email,
+                         'desired': properties})
+        elif current['name'] != properties.get('name'):
+            plan.append({'type': 'users', 'action': 'update', 'name': email,
+                         'desired': properties, 'current': current})
+
+    for name, properties in groups.items():
+        properties = properties or {}
+        current = instance['groups'].get(name)
+        if properties.get('absent', False):
+            if current:
+                plan.append({'type': 'groups', 'action': 'delete',
+                             'name': name, 'current': current})
+            continue
+        members = properties.get('members') or []
+        grants = dict((ds, bool((options or {}).get('view_only', False)))
+                      for ds, options in
+                      (properties.get('datasources') or {}).items())
+        if current:
+            current_grants = dict((ds, bool(options.get('view_only', False)))
+                                  for ds, options in
+                                  current['datasources'].items())
+            if set(members) == set(current['members']) and \
+                    grants == current_grants:
+                continue
+        plan.append({'type': 'groups',
+                     'action': 'update' if current else 'create',
+                     'name': name, 'current': current,
+                     'desired': {'members': members, 'datasources': grants}})
+
+    for name, properties in queries.items():
+        current = instance['queries'].get(name)
+        publish = properties.get('publish', True)
+        schedule = properties.get('schedule', None)
+        if current:
+            ds = instance['datasources'].get(properties['datasource'])
+            if ds is not None and _server_fingerprint(current) == \
+                    _query_fingerprint(ds['id'],
+                                       properties.get('description'),
+                                       properties['query'],
+                                       properties.get('options'),
+                                       schedule, publish):
+                continue
+        plan.append({'type': 'queries',
+                     'action': 'update' if current else 'create',
+                     'name': name, 'current': current,
+                     'desired': properties})
+
+    return plan + removed_ds
+
+
+def _apply_step(step, instance):
+    kind, action, name = step['type'], step['action'], step['name']
+    desired = step.get('desired') or {}
+    current = step.get('current')
+
+    if kind == 'datasources':
+        if action == 'delete':
+            _delete('data_sources/%d' % current['id'])
+            del instance['datasources'][name]
+            return None
+        payload = {
+            'name': name,
+            'type': desired['type'],
+            'options': desired.get('options') or {}
+        }
+        if action == 'create':
+            new_ds = _post('data_sources', data=payload)
+        else:
+            new_ds = _post('data_sources/%d' % current['id'], data=payload)
+        instance['datasources'][name] = new_ds
+        return new_ds
+
+    if kind == 'users':
+        if action == 'create':
+            new_user = _post('users', data={'email': name,
+                                            'name': desired.get('name')})
+        else:
+            new_user = _post('users/%d' % current['id'],
+                             data={'name': desired.get('name')})
+        instance['users'][name] = new_user
+        new_user = dict(new_user)
+        new_user.pop('email', None)
+        return new_user
+
+    if kind == 'groups':
+        if action == 'delete':
+            _delete('groups/%d' % current['id'])
+            del instance['groups'][name]
+            return None
+        if action == 'create':
+            group = _post('groups', data={'name': name})
+            group.pop('name', None)
+            group['members'] = []
+            group['datasources'] = {}
+        else:
+            group = copy.deepcopy(current)
+        for member in desired['members']:
+            if member not in group['members']:
+                user = instance['users'][member]
+                _post('groups/%d/members' % group['id'],
+                      data={'user_id': user['id']})
+                group['members'].append(member)
+        for member in list(group['members']):
+            if member not in desired['members']:
+                user = instance['users'][member]
+                _delete('groups/%d/members/%d' % (group['id'], user['id']))
+                group['members'].remove(member)
+        for ds_name, view_only in desired['datasources'].items():
+            ds_id = instance['datasources'][ds_name]['id']
+            if ds_name not in group['datasources']:
+                _post('groups/%d/data_sources' % group['id'],
+                      data={'data_source_id': ds_id})
+                group['datasources'][ds_name] = {'view_only': False}
+            if group['datasources'][ds_name].get('view_only', False) != \
+                    view_only:
+                _post('groups/%d/data_sources/%d' % (group['id'], ds_id),
+                      data={'view_only': view_only})
+                group['datasources'][ds_name] = {'view_only': view_only}
+        for ds_name in list(group['datasources'].keys()):
+            if ds_name not in desired['datasources']:
+                ds_id = instance['datasources'][ds_name]['id']
+                _delete('groups/%d/data_sources/%d' % (group['id'], ds_id))
+                del group['datasources'][ds_name]
+        instance['groups'][name] = group
+        return group
+
+    if kind == 'queries':
+        publish = desired.get('publish', True)
+        schedule = desired.get('schedule', None)
+        datasource = desired['datasource']
+        ds_id = instance['datasources'][datasource]['id']
+        if action == 'create':
+            new_query = _create_query(name, ds_id,
+                                      desired.get('description'),
+                                      desired['query'],
+                                      desired.get('options') or {},
+                                      schedule, publish)
+        else:
+            payload = {
+                'name': name,
+                'data_source_id': ds_id,
+                'description': desired.get('description'),
+                'options': desired.get('options') or {},
+                'query': desired['query'],
+                'schedule': schedule,
+                'is_draft': not publish
+            }
+            new_query = _post('queries/%d' % current['id'], data=payload)
+        instance['queries'][name] = new_query
+        new_query = dict(new_query)
+        new_query.pop('name', None)
+        new_query.pop('data_source_id', None)
+        new_query['datasource'] = datasource
+        return new_query
+
+
+# A user or query of the instance shaped like _apply_step returns them, so
+# that the changes compare like with like
+def _reported(kind, item, instance):
+    if kind not in ('users', 'queries') or not isinstance(item, dict):
+        return item
+    item = dict(item)
+    if kind == 'users':
+        item.pop('email', None)
+        return item
+    item.pop('name', None)
+    ds_id = item.pop('data_source_id', None)
+    item['datasource'] = None
+    for ds_name, ds in instance['datasources'].items():
+        if ds['id'] == ds_id:
+            item['datasource'] = ds_name
+    return item
+
+
+@_profiled
+def sync(tree=None, test=False, profile=None):
+    '''
+    Reconcile the whole Redash instance against a ``redash`` pillar tree.
+
+    Every collection is read once, a single plan is computed and then applied
+    in dependency order. With ``test=True`` the plan is only reported.
+    '''
+    if tree is None:
+        tree = __salt__['pillar.get']('redash', {})
+    instance = _read_instance([kind for kind in tree if tree[kind]])
+    plan = _plan(tree, instance)
+    ret = {
+        'changes': {},
+        'errors': [],
+        'failed': {}
+    }
+    for step in plan:
+        kind, name = step['type'], step['name']
+        current = step.get('current')
+        old = 'Not present' if step['action'] == 'create' \
+            else _reported(kind, current, instance)
+        if test:
+            new = None if step['action'] == 'delete' \
+                else step.get('desired')
+        else:
+            try:
+                new = _apply_step(step, instance)
+            except (CommandExecutionError, KeyError) as exc:
+                error = 'Could not %s %s %s: %s' % (step['action'], kind,
+                                                    name, exc)
+                log.error(error)
+                ret['errors'].append(error)
+                ret['failed'].setdefault(kind, {})[name] = error
+                continue
+        ret['changes'].setdefault(kind, {})[name] = {
+            'old': {
+                name: old
+            },
+            'new': {
+                name: new
+            }
+        }
+    return ret
+
+
+# sync against one profile, timed and with its errors caught
+def _sync_profile(profile, tree, test):
+    start = time.time()
+    try:
+        ret = sync(tree=tree, test=test, profile=profile)
+    except CommandExecutionError as exc:
+        log.error('Could not sync profile %s: %s' % (profile, exc))
+        ret = {'changes': {}, 'errors': [str(exc)], 'failed': {}}
+    ret['time'] = time.time() - start
+    return ret
+
+
+def sync_profiles(profiles=None, tree=None, test=False):
+    '''
+    Run sync with the same ``redash`` pillar tree (or ``tree``) against the
+    given connection profiles, by default all of ``redash:profiles``,
+    concurrently. Returns the result and duration of every profile.
+    '''
+    if tree is None:
+        tree = __salt__['pillar.get']('redash', {})
+    if profiles is None:
+        profiles = sorted(__salt__['config.get']('redash:profiles', {}))
+    if isinstance(profiles, str):
+        profiles = [profiles]
+    ret = {}
+    if not profiles:
+        return ret
+    with ThreadPoolExecutor(max_workers=len(profiles)) as pool:
+        futures = [(profile, _submit(pool, _sync_profile, profile, tree,
+                                     test))
+                   for profile in profiles]
+        for profile, future in futures:
+            ret[profile] = future.result()
+    return ret
+
+
+# Drop what is only valid during one run, for long-lived callers such as
+# the beacon. The client and its pooled connections are kept.
+def _new_run():
+    for key in ('redash.memberships', 'redash.query_store',
+                'redash.snapshots', 'redash.fetched', 'redash.query_applied',
+                'redash.lookups', 'redash.deadline'):
+        _context().pop(key, None)
+    _cache().clear()
+
+
+@_profiled
+def drift(tree=None, profile=None):
+    '''
+    Compare the queries and data sources of the ``redash`` pillar tree (or
+    ``tree``) with the server using the plain listings, and return those
+    that drifted by type and name with the fingerprint of what the server
+    holds. Queries come from the incrementally updated copy and only the
+    managed data sources are fetched in detail.
+    '''
+    if tree is None:
+        tree = __salt__['pillar.get']('redash', {})
+    _new_run()
+    ret = {
+        'datasources': {},
+        'queries': {}
+    }
+    data_sources = dict((ds['name'], ds)
+                        for ds in _collection('data_sources'))
+
+    managed = {}
+    for name, properties in (tree.get('datasources') or {}).items():
+        properties = properties or {}
+        current = data_sources.get(name)
+        if properties.get('absent', False):
+            if current:
+                ret['datasources'][name] = {'drift': 'present',
+                                            'fingerprint': None}
+        elif not current:
+            ret['datasources'][name] = {'drift': 'missing',
+                                        'fingerprint': None}
+        else:
+            managed[name] = properties
+    details = _datasource_details(data_sources[name]['id']
+                                  for name in managed)
+    for (name, properties), current in zip(managed.items(), details):
+        options = dict((key, value) for key, value in
+                       (current.get('options') or {}).items()
+                       if key not in _SECRET_OPTIONS)
+        fingerprint = hashlib.sha256(json.dumps(
+            [current['type'], options], sort_keys=True).encode('utf-8')) \
+            .hexdigest()
+        if properties.get('type') != current['type'] or \
+                not _options_equal(properties.get('options'),
+                                   current.get('options')):
+            ret['datasources'][name] = {'drift': 'changed',
+                                        'fingerprint': fingerprint}
+
+    queries = _desired_queries(tree.get('queries'))
+    if queries:
+        current = dict((query['name'], query)
+                       for query in _query_store()['queries'].values())
+        for name, properties in queries.items():
+            query = current.get(name)
+            if query is None:
+                ret['queries'][name] = {'drift': 'missing',
+                                        'fingerprint': None}
+                continue
+            ds = data_sources.get(properties.get('datasource'), {})
+            desired = _query_fingerprint(
+                ds.get('id'), properties.get('description'),
+                properties.get('query'), properties.get('options'),
+                properties.get('schedule'), properties.get('publish', True))
+            fingerprint = _server_fingerprint(query)
+            if desired != fingerprint:
+                ret['queries'][name] = {'drift': 'changed',
+                                        'fingerprint': fingerprint}
+    return ret
+
+
+@_profiled
+def list_dashboards(id=None, profile=None):
     return _get('dashboards', id=id)
 
 
-def list_alerts(id=None):
+@_profiled
+def list_alerts(id=None, profile=None):
     return _get('alerts', id=id)
+
+
+@_profiled
+def pool_stats(profile=None):
+    return _client().pool_stats()
+
+
+@_profiled
+def breaker_status(profile=None):
+    '''
+    Report the circuit breaker of the Redash API: its state (closed, open or
+    half-open), the consecutive failures, how many times it tripped, when it
+    lets a request through again and the last error.
+    '''
+    ret = _breaker().status()
+    deadline = _context().get('redash.deadline')
+    ret['budget_left'] = round(max(deadline - time.time(), 0.0), 3) \
+        if deadline is not None else None
+    return ret
+
+
+@_profiled
+def unavailable(profile=None):
+    '''
+    Return why Redash API calls would fail right now, or None when they can
+    be made. The first call of a state run starts its time budget,
+    ``redash:run_budget`` seconds.
+    '''
+    budget = float(_config('run_budget', 0))
+    if budget > 0:
+        _context().setdefault('redash.deadline', time.time() + budget)
+    return _refusal()
+
+
+@_profiled
+def cache_stats(profile=None):
+    return _cache().stats()
+
+
+@_profiled
+def clear_cache(profile=None):
+    _cache().clear()
+    return True
+
+
+@_profiled
+def stats(reset=False, fire_event=False, profile=None):
+    '''
+    Report the API requests made during this run: count, errors, bytes
+    received and p50/p95 latency per endpoint, plus the totals.
+    '''
+    ret = _stats().summary()
+    ret['pool'] = _client().pool_stats() if 'redash.client' in _context() \
+        else {}
+    ret['cache'] = _cache().stats()
+    ret['breaker'] = _breaker().status()
+    if fire_event:
+        __salt__['event.send']('redash/stats', ret)
+    if reset:
+        _stats().reset()
+    return ret
+
+
+@_profiled
+def request_totals(profile=None):
+    '''
+    Report the count and total time of the API requests made during this
+    run, without the per-endpoint breakdown of redash.stats.
+    '''
+    return _stats().totals()
+
+
+@_profiled
+def clear_snapshots(profile=None):
+    for path in _SNAPSHOT_COLLECTIONS:
+        _context().setdefault('redash.snapshots', {}).pop(path, None)
+        _snapshot_store().flush(_snapshot_bank(), path)
+    return True
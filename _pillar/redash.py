@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+'''
+Pillar data from the results of Redash queries.
+
+The results are fetched through the redash execution module of this formula,
+so it has to be synced to the master (``salt-run saltutil.sync_all``) and
+the connection configured in the master configuration:
+
+.. code-block:: yaml
+
+    redash:
+      api_url: 'http://redash.example.com/api'
+      api_key: 'changeme'
+
+    ext_pillar:
+      - redash:
+          queries:
+            inventory: 'Host inventory'
+            datacenters: 'Datacenters'
+          ttl: 300
+          stale: 3600
+          # Connection profile from redash:profiles, if not the default one
+          # profile: eu
+
+Every pillar key gets the rows of the latest result of its query. Results are
+kept in the master cache, which every master worker shares: within ``ttl``
+seconds they are served as they are. For ``stale`` more seconds they are
+still served while a single render revalidates them, and after that renders
+wait for one of them to fetch the result again. Either way a query is
+fetched at most once per window however many minions render their pillar.
+'''
+
+import hashlib
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+import salt.cache
+
+# Define the module's virtual name
+__virtualname__ = 'redash'
+
+log = logging.getLogger(__name__)
+
+_BANK = 'redash/pillar'
+
+
+def __virtual__():
+    if not HAS_FCNTL:
+        return False, 'The redash ext_pillar needs fcntl'
+    return __virtualname__
+
+
+# Cache key of a query, per Redash instance
+def _key(name, profile=None):
+    api_url = __salt__['config.get']('redash:api_url', '')
+    if profile is not None:
+        api_url = __salt__['config.get']('redash:profiles:%s:api_url'
+                                         % profile, api_url)
+    return hashlib.sha1(('%s %s' % (api_url, name)).encode('utf-8')) \
+        .hexdigest()
+
+
+# Hold the lock file of a cache key, yielding whether it was acquired. Only
+# blocking locks wait for it to be released.
+@contextmanager
+def _locked(key, blocking=True):
+    directory = os.path.join(__opts__['cachedir'], 'redash', 'pillar')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, '%s.lock' % key), 'a') as handle:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX |
+                        (0 if blocking else fcntl.LOCK_NB))
+        except (IOError, OSError):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+# Fetch a result and store it, keeping what is cached on failure
+def _fetch(cache, key, name, entry, profile):
+    try:
+        result = __salt__['redash.get_query_result'](name, profile=profile)
+    except Exception as exc:
+        log.error('Could not fetch the result of query %s: %s' % (name, exc))
+        return entry
+    entry = {
+        'fetched': time.time(),
+        'result_id': result['result_id'],
+        'rows': result['rows']
+    }
+    cache.store(_BANK, key, entry)
+    return entry
+
+
+def _result(cache, name, ttl, stale, profile):
+    key = _key(name, profile)
+    entry = cache.fetch(_BANK, key)
+    age = time.time() - entry['fetched'] if entry else None
+    if entry and age < ttl:
+        return entry
+    if entry and age < ttl + stale:
+        # Whoever gets the lock revalidates, the others keep the stale rows
+        with _locked(key, blocking=False) as locked:
+            if locked:
+                entry = cache.fetch(_BANK, key) or entry
+                if time.time() - entry['fetched'] >= ttl:
+                    entry = _fetch(cache, key, name, entry, profile)
+        return entry
+    with _locked(key) as locked:
+        # Somebody else may have fetched it while we waited
+        entry = cache.fetch(_BANK, key) or entry
+        if not entry or time.time() - entry['fetched'] >= ttl:
+            entry = _fetch(cache, key, name, entry, profile)
+    return entry
+
+
+def ext_pillar(minion_id, pillar, queries=None, ttl=300, stale=3600,
+               profile=None):
+    '''
+    Map pillar keys to the rows of the latest result of Redash queries.
+    '''
+    cache = salt.cache.factory(__opts__)
+    ret = {}
+    for pillar_key, name in (queries or {}).items():
+        entry = _result(cache, name, int(ttl), int(stale), profile)
+        if entry is None:
+            continue
+        ret[pillar_key] = entry['rows']
+    return ret
@@ -6,7 +6,13 @@ Interact with Redash.
 https://redash.io
 '''
 
+import difflib
+import json
 import logging
+import os
+
+import salt.utils.yaml
+from salt.exceptions import CommandExecutionError
 
 # Define the module's virtual name
 __virtualname__ = 'redash'
@@ -14,6 +20,23 @@ __virtualname__ = 'redash'
 log = logging.getLogger(__name__)
 
 
+# API traffic so far, only taken when redash:stats_in_comment is set
+def _api_totals(profile=None):
+    if not __salt__['config.get']('redash:stats_in_comment', False):
+        return None
+    return __salt__['redash.request_totals'](profile=profile)
+
+
+# Optionally append the API traffic of a state to its comment
+def _summarize(ret, before, profile=None):
+    if before is not None:
+        after = __salt__['redash.request_totals'](profile=profile)
+        ret['comment'] = '%s (%d API requests in %.3fs)' % (
+            ret['comment'], after['count'] - before['count'],
+            after['time'] - before['time'])
+    return ret
+
+
 def _compare_hashes(hash1, hash2, filter=[]):
     log.debug('Hash1: %s' % hash1)
     log.debug('Hash2: %s' % hash2)
@@ -33,13 +56,128 @@ def _compare_hashes(hash1, hash2, filter=[]):
     return True
 
 
-def datasource_present(name, type, options, force=False):
+# Keys whose values never show in state changes
+_SECRETS = ['password']
+_MASK = '********'
+# Keys every write changes
+_VOLATILE = ('updated_at', 'version')
+
+
+def _masked(value):
+    if isinstance(value, dict):
+        return dict((key, _MASK if key in _SECRETS else _masked(item))
+                    for key, item in value.items())
+    if isinstance(value, list):
+        return [_masked(item) for item in value]
+    return value
+
+
+def _scalars(values):
+    return all(not isinstance(value, (dict, list)) for value in values)
+
+
+# Changed leaves of two objects by dotted path: lists of plain values as
+# added and removed items, SQL and other multi-line text as a unified diff
+def _diff(old, new, path=''):
+    changes = {}
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(set(old) | set(new), key=str):
+            if not path and key in _VOLATILE:
+                continue
+            subpath = '%s.%s' % (path, key) if path else str(key)
+            if key in _SECRETS:
+                if old.get(key) != new.get(key):
+                    changes[subpath] = {'old': _MASK, 'new': _MASK}
+                continue
+            changes.update(_diff(old.get(key), new.get(key), subpath))
+    elif old == new:
+        pass
+    elif isinstance(old, list) and isinstance(new, list) and \
+            _scalars(old + new):
+        changes[path] = {
+            'added': [value for value in new if value not in old],
+            'removed': [value for value in old if value not in new]
+        }
+    elif isinstance(old, str) and isinstance(new, str) and \
+            (path == 'query' or '\n' in old or '\n' in new):
+        changes[path] = {'diff': '\n'.join(difflib.unified_diff(
+            old.splitlines(), new.splitlines(), 'old', 'new', n=1,
+            lineterm=''))}
+    else:
+        changes[path] = {'old': _masked(old), 'new': _masked(new)}
+    return changes
+
+
+# Changes of an object: its changed paths when it was updated, the whole
+# object when it was created or removed
+def _object_changes(old, new):
+    if old == 'Not present' or old is None:
+        return {'old': 'Not present', 'new': _masked(new)}
+    if new is None:
+        return {'old': _masked(old), 'new': 'Not present'}
+    return _diff(old, new)
+
+
+# Past redash:changes_max_size bytes the changes of a state only list what
+# changed
+def _capped(changes, paths=None):
+    limit = int(__salt__['config.get']('redash:changes_max_size', 16384))
+    size = len(json.dumps(changes, default=str))
+    if not limit or size <= limit:
+        return changes
+    return {
+        'truncated': '%d bytes of changes, over the limit of %d'
+                     % (size, limit),
+        'paths': sorted(paths if paths is not None else changes)[:100]
+    }
+
+
+def _changes(old, new):
+    return _capped(_object_changes(old, new))
+
+
+# Changes reported by redash.sync, by kind and name
+def _sync_changes(changes):
+    compact = {}
+    for kind, objects in changes.items():
+        for name, change in objects.items():
+            compact.setdefault(kind, {})[name] = _object_changes(
+                change['old'][name], change['new'][name])
+    return compact
+
+
+# Fail a state at once, with the reason as comment, when its Redash API
+# calls cannot succeed: the time budget of the run is spent or the circuit
+# breaker is open
+def _unavailable(ret, profile=None):
+    reason = __salt__['redash.unavailable'](profile=profile)
+    if reason is None:
+        return None
+    ret['result'] = False
+    ret['comment'] = reason
+    return ret
+
+
+# Result computed for this state by mod_aggregate, if any
+def _aggregated(fun, name, profile=None):
+    return __context__.get('redash.aggregated', {}).pop((fun, name, profile),
+                                                        None)
+
+
+def datasource_present(name, type, options, force=False, profile=None,
+                       **kwargs):
     ret = {'name': name,
            'changes': {},
            'result': False,
            'comment': ''}
+    before = _api_totals(profile)
+    aggregated = _aggregated('datasource_present', name, profile)
+    if aggregated:
+        return _summarize(aggregated, before, profile)
+    if _unavailable(ret, profile):
+        return ret
 
-    res = __salt__['redash.list_datasources'](name=name)
+    res = __salt__['redash.list_datasources'](name=name, profile=profile)
     # Check if datasource exists
     if name in res.keys():
         existing_ds = res[name]
@@ -47,56 +185,50 @@ def datasource_present(name, type, options, force=False):
         # than the defintion
         log.debug('Datasource info for %s: %s' % (name, existing_ds))
         existing_options = existing_ds['options']
+        # Compared like redash.sync does
         if force or type != existing_ds['type'] \
-                or not _compare_hashes(options, existing_options,
-                                       filter=['password']):
+                or not __salt__['redash.datasource_options_equal'](
+                    options, existing_options):
             # Need to update the DS
             updated_ds = __salt__['redash.alter_datasource'](
                 id=existing_ds['id'],
                 name=name, type=type,
-                options=options)
+                options=options, profile=profile)
+            # Grants are left alone, the response only has their ids
+            updated_ds.pop('name', None)
+            updated_ds['groups'] = existing_ds['groups']
             ret['result'] = True
             ret['comment'] = 'Datasource was updated'
-            ret['changes'] = {
-                'old': {
-                    name: existing_ds
-                },
-                'new': {
-                    name: updated_ds
-                }
-            }
+            ret['changes'] = _changes(existing_ds, updated_ds)
         else:
             ret['result'] = True
             ret['comment'] = 'Datasource is present'
     else:
         # Create the datasource if not present
         new_ds = __salt__['redash.add_datasource'](name=name, type=type,
-                                                   options=options)
+                                                   options=options,
+                                                   profile=profile)
         if (new_ds):
             ret['result'] = True
             ret['comment'] = 'Datasource created'
-            ret['changes'] = {
-                'old': {
-                    name: 'Not present'
-                },
-                'new': {
-                    name: updated_ds
-                }
-            }
+            ret['changes'] = _changes(None, new_ds)
 
-    return ret
+    return _summarize(ret, before, profile)
 
 
-def datasource_absent(name):
+def datasource_absent(name, profile=None, **kwargs):
     ret = {'name': name,
        'changes': {},
        'result': False,
        'comment': ''}
+    before = _api_totals(profile)
+    if _unavailable(ret, profile):
+        return ret
     # Check if datasource_absent is present
-    res = __salt__['redash.list_datasources'](name=name)
+    res = __salt__['redash.list_datasources'](name=name, profile=profile)
     if name in res.keys():
         old_datasource = res[name]
-        __salt__['redash.remove_datasource'](name=name)
+        __salt__['redash.remove_datasource'](name=name, profile=profile)
         ret['result'] = True
         ret['comment'] = 'Datasource was removed'
         ret['changes'] = {
@@ -110,17 +242,49 @@ def datasource_absent(name):
     else:
         ret['result'] = True
         ret['comment'] = 'Datasource is absent'
-    return ret
+    return _summarize(ret, before, profile)
 
 
 def query_present(name, datasource, description, query, options={},
-                  schedule=None, publish=True):
+                  schedule=None, publish=True, profile=None, **kwargs):
     ret = {'name': name,
            'changes': {},
            'result': False,
            'comment': ''}
+    before = _api_totals(profile)
+    aggregated = _aggregated('query_present', name, profile)
+    if aggregated:
+        return _summarize(aggregated, before, profile)
+    if _unavailable(ret, profile):
+        return ret
 
-    res = __salt__['redash.list_queries'](name=name)
+    # Queries applied before and untouched on the server since are skipped
+    # without any per-query request.
+    incremental = __salt__['config.get']('redash:incremental_queries', False)
+    if incremental:
+        digest = __salt__['redash.query_fingerprint'](
+            datasource, description, query, options=options,
+            schedule=schedule, publish=publish, profile=profile)
+        if __salt__['redash.query_unchanged'](name=name, digest=digest,
+                                              profile=profile):
+            ret['result'] = True
+            ret['comment'] = 'Query is present'
+            return _summarize(ret, before, profile)
+
+    # Matching fingerprints spare the data source and group lookups
+    if __salt__['redash.query_matches'](name=name, datasource=datasource,
+                                        description=description,
+                                        query=query, options=options,
+                                        schedule=schedule, publish=publish,
+                                        profile=profile):
+        ret['result'] = True
+        ret['comment'] = 'Query is present'
+        if incremental:
+            __salt__['redash.remember_query'](name=name, digest=digest,
+                                              profile=profile)
+        return _summarize(ret, before, profile)
+
+    res = __salt__['redash.list_queries'](name=name, profile=profile)
     # Check if query exists
     if name in res.keys():
         existing_query = res[name]
@@ -142,17 +306,11 @@ def query_present(name, datasource, description, query, options={},
                 query=query,
                 options=options,
                 schedule=schedule,
-                publish=publish)
+                publish=publish,
+                id=existing_query['id'], profile=profile)
             ret['result'] = True
             ret['comment'] = 'Query was updated'
-            ret['changes'] = {
-                'old': {
-                    name: existing_query
-                },
-                'new': {
-                    name: res[name]
-                }
-            }
+            ret['changes'] = _changes(existing_query, res[name])
         else:
             ret['result'] = True
             ret['comment'] = 'Query is present'
@@ -165,27 +323,29 @@ def query_present(name, datasource, description, query, options={},
             query=query,
             options=options,
             schedule=schedule,
-            publish=publish)
+            publish=publish, profile=profile)
         ret['result'] = True
         ret['comment'] = 'Datasource created'
-        ret['changes'] = {
-            'old': {
-                name: 'Not present'
-            },
-            'new': {
-                name: res[name]
-            }
-        }
+        ret['changes'] = _changes(None, res[name])
 
-    return ret
+    if incremental:
+        __salt__['redash.remember_query'](name=name, digest=digest,
+                                          profile=profile)
+    return _summarize(ret, before, profile)
 
 
-def user_present(email, name):
+def user_present(email, name, profile=None, **kwargs):
     ret = {'name': email,
            'changes': {},
            'result': False,
            'comment': ''}
-    res = __salt__['redash.list_users'](email=email)
+    before = _api_totals(profile)
+    aggregated = _aggregated('user_present', email, profile)
+    if aggregated:
+        return _summarize(aggregated, before, profile)
+    if _unavailable(ret, profile):
+        return ret
+    res = __salt__['redash.list_users'](email=email, profile=profile)
     log.debug('Result received from module: %s' % res)
     # Check if the user is already there
     if email in res.keys():
@@ -197,44 +357,39 @@ def user_present(email, name):
             ret['comment'] = 'User is present'
         else:
             # If the user exists, then update the required attributes
-            res = __salt__['redash.alter_user'](email=email, name=name)
+            res = __salt__['redash.alter_user'](email=email, name=name,
+                                                id=user['id'],
+                                                profile=profile)
             if res:
                 ret['result'] = True
                 ret['comment'] = 'User was updated'
-                ret['changes'] = {
-                    'old': {
-                        email: user
-                    },
-                    'new': {
-                        email: res[email]
-                    }
-                }
+                ret['changes'] = _changes(user, res[email])
     else:
         # We have no user here, let's create it.
-        res = __salt__['redash.add_user'](email=email, name=name)
+        res = __salt__['redash.add_user'](email=email, name=name,
+                                          profile=profile)
         if res:
             ret['result'] = True
             ret['comment'] = 'User was created'
-            ret['changes'] = {
-                'old': {
-                    email: 'Not present'
-                },
-                'new': {
-                    email: res[email]
-                }
-            }
+            ret['changes'] = _changes(None, res[email])
     # Return the result
-    return ret
+    return _summarize(ret, before, profile)
 
 
-def group_present(name, members=[], datasources={}):
+def group_present(name, members=[], datasources={}, profile=None, **kwargs):
     ret = {'name': name,
        'changes': {},
        'result': False,
        'comment': ''}
+    before = _api_totals(profile)
+    aggregated = _aggregated('group_present', name, profile)
+    if aggregated:
+        return _summarize(aggregated, before, profile)
+    if _unavailable(ret, profile):
+        return ret
     changes = False
     # Check if group is present. 
-    res = __salt__['redash.list_groups'](name=name)
+    res = __salt__['redash.list_groups'](name=name, profile=profile)
     if name in res.keys():
         old_group = res[name]
         cur_group = res[name]
@@ -243,7 +398,7 @@ def group_present(name, members=[], datasources={}):
         cur_group = None
     # If not present, then create it.
     if not cur_group:
-        res = __salt__['redash.add_group'](name=name)
+        res = __salt__['redash.add_group'](name=name, profile=profile)
         cur_group = res[name]
 
     # Now we have a group. Let's check if we need to change the members list.
@@ -257,63 +412,57 @@ def group_present(name, members=[], datasources={}):
             members_remove.append(member)
     log.debug('Members to add: %s' % members_add)
     log.debug('Members to remove: %s' % members_remove)
-    for member in members_add:
-        __salt__['redash.add_group_member'](name=name, member=member)
-        changes = True
-    for member in members_remove:
-        __salt__['redash.remove_group_member'](name=name, member=member)
+    if members_add or members_remove:
+        res = __salt__['redash.set_group_members'](name=name,
+                                                   members=members,
+                                                   profile=profile)
+        cur_group = res[name]
         changes = True
 
-    # Similar procedure for the datasources.
-    ds_add = []
-    ds_remove = []
-    for ds in datasources:
-        if ds not in cur_group['datasources']:
-            ds_add.append(ds)
+    # Similar procedure for the datasources, including their visibility.
+    ds_changes = []
+    for ds, options in datasources.items():
+        view_only = bool((options or {}).get('view_only', False))
+        if ds not in cur_group['datasources'] or \
+                cur_group['datasources'][ds].get('view_only', False) != \
+                view_only:
+            ds_changes.append(ds)
     for ds in cur_group['datasources']:
         if ds not in datasources:
-            ds_remove.append(member)
-    log.debug('Datasources to add: %s' % ds_add)
-    log.debug('Datasources to remove: %s' % ds_remove)
-    for ds in ds_add:
-        __salt__['redash.add_group_datasource'](name=name, datasource=ds)
-        changes = True
-    for ds in ds_remove:
-        __salt__['redash.remove_group_datasource'](name=name, datasource=ds)
+            ds_changes.append(ds)
+    log.debug('Datasources to change: %s' % ds_changes)
+    if ds_changes:
+        res = __salt__['redash.set_group_datasources'](
+            name=name, datasources=datasources, profile=profile)
+        cur_group = res[name]
         changes = True
 
-    # Now we get the current view of the new group
-    cur_group = __salt__['redash.list_groups'](name=name)
-
     # Fill in the old and new values and it should be all done.
     if not old_group:
         ret['comment'] = 'Group was created'
+        ret['changes'] = _changes(None, cur_group)
     elif changes:
         ret['comment'] = 'Group was updated'
-        ret['changes'] = {
-            'old': {
-                name: old_group
-            },
-            'new': {
-                name: cur_group
-            }
-        }
+        ret['changes'] = _changes(old_group, cur_group)
     else:
         ret['comment'] = 'Group is present and in the desired state'
     ret['result'] = True
-    return ret
+    return _summarize(ret, before, profile)
 
 
-def group_absent(name):
+def group_absent(name, profile=None, **kwargs):
     ret = {'name': name,
        'changes': {},
        'result': False,
        'comment': ''}
+    before = _api_totals(profile)
+    if _unavailable(ret, profile):
+        return ret
     # Check if group is present
-    res = __salt__['redash.list_groups'](name=name)
+    res = __salt__['redash.list_groups'](name=name, profile=profile)
     if name in res.keys():
         old_group = res[name]
-        __salt__['redash.remove_group'](name=name)
+        __salt__['redash.remove_group'](name=name, profile=profile)
         ret['result'] = True
         ret['comment'] = 'Group was removed'
         ret['changes'] = {
@@ -327,4 +476,413 @@ def group_absent(name):
     else:
         ret['result'] = True
         ret['comment'] = 'Group is absent'
+    return _summarize(ret, before, profile)
+
+
+def managed(name, tree=None, profile=None, profiles=None, **kwargs):
+    '''
+    Reconcile the whole Redash instance against the ``redash`` pillar tree
+    (or ``tree`` when given) with a single read of every collection. With
+    ``profiles`` the same tree is applied to all those instances at once.
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': False,
+           'comment': ''}
+    if profiles:
+        return _managed_profiles(ret, tree, profiles)
+    before = _api_totals(profile)
+    if _unavailable(ret, profile):
+        return ret
+    res = __salt__['redash.sync'](tree=tree, test=__opts__['test'],
+                                  profile=profile)
+    ret['changes'] = _capped(_sync_changes(res['changes']),
+                             ['%s.%s' % (kind, name)
+                              for kind in res['changes']
+                              for name in res['changes'][kind]])
+    if res['errors']:
+        ret['comment'] = '\n'.join(res['errors'])
+    elif not res['changes']:
+        ret['result'] = True
+        ret['comment'] = 'Redash instance is in the desired state'
+    elif __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'Redash instance would be updated'
+    else:
+        ret['result'] = True
+        ret['comment'] = 'Redash instance was updated'
+    return _summarize(ret, before, profile)
+
+
+# managed across several profiles, reporting every instance and its timing
+def _managed_profiles(ret, tree, profiles):
+    res = __salt__['redash.sync_profiles'](profiles=profiles, tree=tree,
+                                           test=__opts__['test'])
+    comments = []
+    for profile in sorted(res):
+        outcome = res[profile]
+        if outcome['errors']:
+            summary = 'failed: %s' % '; '.join(outcome['errors'])
+        elif not outcome['changes']:
+            summary = 'in the desired state'
+        elif __opts__['test']:
+            summary = 'would be updated'
+        else:
+            summary = 'updated'
+        comments.append('%s %s in %.3fs' % (profile, summary,
+                                            outcome['time']))
+        if outcome['changes']:
+            ret['changes'][profile] = _sync_changes(outcome['changes'])
+    if any(outcome['errors'] for outcome in res.values()):
+        ret['result'] = False
+    elif ret['changes'] and __opts__['test']:
+        ret['result'] = None
+    else:
+        ret['result'] = True
+    ret['comment'] = '\n'.join(comments)
+    ret['changes'] = _capped(ret['changes'],
+                             ['%s.%s.%s' % (profile, kind, name)
+                              for profile, kinds in ret['changes'].items()
+                              for kind in kinds for name in kinds[kind]])
+    return ret
+
+
+def queries_refreshed(name, names=None, prefix=None, datasource=None,
+                      concurrency=None, per_datasource=None, timeout=None,
+                      profile=None, **kwargs):
+    '''
+    Refresh the queries given by ``names``, by name ``prefix`` or bound to
+    ``datasource`` (by default the query called ``name``) with bounded
+    concurrency, waiting for their results.
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': False,
+           'comment': ''}
+    before = _api_totals(profile)
+    if _unavailable(ret, profile):
+        return ret
+    if not names and not prefix and not datasource:
+        names = [name]
+    res = __salt__['redash.refresh_queries'](
+        names=names, prefix=prefix, datasource=datasource,
+        concurrency=concurrency, per_datasource=per_datasource,
+        timeout=timeout, test=__opts__['test'], profile=profile)
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = '%d queries would be refreshed' % len(res)
+        return _summarize(ret, before, profile)
+    failed = sorted(query for query, refresh in res.items()
+                    if refresh['status'] != 'success')
+    ret['changes'] = res
+    if failed:
+        ret['comment'] = 'Could not refresh queries: %s' % ', '.join(failed)
+    else:
+        ret['result'] = True
+        ret['comment'] = '%d queries were refreshed' % len(res)
+    return _summarize(ret, before, profile)
+
+
+def query_result_file(name, query, format='csv', compress=False,
+                      makedirs=False, force=False, mode=None, user=None,
+                      group=None, profile=None, **kwargs):
+    '''
+    Keep the file ``name`` holding the latest result of ``query`` as ``csv``
+    or ``json``, optionally gzip-compressed, with the given ``mode``,
+    ``user`` and ``group``. The result is streamed to disk and only
+    downloaded again when it changed.
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': False,
+           'comment': ''}
+    before = _api_totals(profile)
+    if _unavailable(ret, profile):
+        return ret
+    if makedirs and not __opts__['test']:
+        __salt__['file.makedirs'](name)
+    res = __salt__['redash.fetch_query_result'](
+        name=query, path=name, format=format, compress=compress,
+        force=force, test=__opts__['test'], mode=mode, user=user,
+        group=group, profile=profile)
+    if not res['changed']:
+        ret['result'] = True
+        ret['comment'] = 'Result %d of query %s is present' % (
+            res['result_id'], query)
+    elif __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'Result %d of query %s would be %s' % (
+            res['result_id'], query, 'downloaded' if res['downloaded']
+            else 'given its mode and owner')
+    else:
+        ret['result'] = True
+        ret['comment'] = 'Result %d of query %s was %s' % (
+            res['result_id'], query, 'downloaded' if res['downloaded']
+            else 'given its mode and owner')
+        ret['changes'] = res
+    return _summarize(ret, before, profile)
+
+
+# Split the YAML front matter, between two --- lines at the top of a file,
+# from the SQL after it
+def _front_matter(text):
+    lines = text.splitlines(True)
+    if not lines or lines[0].strip() != '---':
+        return {}, text
+    for position, line in enumerate(lines[1:], 1):
+        if line.strip() == '---':
+            meta = salt.utils.yaml.safe_load(''.join(lines[1:position]))
+            return meta or {}, ''.join(lines[position + 1:])
+    return {}, text
+
+
+def queries_from_dir(name, datasource=None, description='', schedule=None,
+                     publish=True, options=None, concurrency=None,
+                     force=False, saltenv='base', profile=None, **kwargs):
+    '''
+    Keep a query for every ``.sql`` file under the ``salt://`` directory
+    ``name``, called after its path without the extension. Front matter may
+    set the ``name``, ``datasource``, ``description``, ``schedule``,
+    ``publish`` and ``options`` of a query, the arguments give the defaults.
+
+    Only files whose definition changed since the last successful apply are
+    uploaded, concurrently, unless ``force`` is set.
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': False,
+           'comment': ''}
+    before = _api_totals(profile)
+    if _unavailable(ret, profile):
+        return ret
+    files = __salt__['cp.cache_dir'](name, saltenv, include_pat='*.sql')
+    root = os.path.join(__opts__['cachedir'], 'files', saltenv,
+                        name[len('salt://'):].strip('/'))
+    queries = {}
+    errors = []
+    for path in sorted(files):
+        if not path.endswith('.sql'):
+            continue
+        relative = os.path.relpath(path, root)[:-len('.sql')]
+        with open(path) as handle:
+            try:
+                meta, sql = _front_matter(handle.read())
+            except salt.utils.yaml.YAMLError as exc:
+                errors.append('Invalid front matter in %s: %s'
+                              % (relative, exc))
+                continue
+        if not isinstance(meta, dict):
+            errors.append('Invalid front matter in %s: expected a mapping,'
+                          ' got %s' % (relative, type(meta).__name__))
+            continue
+        definition = {
+            'datasource': meta.get('datasource', datasource),
+            'description': meta.get('description', description),
+            'query': sql.strip(),
+            'options': meta.get('options', options) or {},
+            'schedule': meta.get('schedule', schedule),
+            'publish': meta.get('publish', publish)
+        }
+        if not definition['datasource']:
+            errors.append('No datasource for %s' % relative)
+            continue
+        queries[meta.get('name', relative.replace(os.sep, '/'))] = \
+            definition
+    if errors:
+        ret['comment'] = '\n'.join(errors)
+        return _summarize(ret, before, profile)
+
+    res = __salt__['redash.upload_queries'](
+        queries, source='%s:%s' % (saltenv, name), concurrency=concurrency,
+        force=force, test=__opts__['test'], profile=profile)
+    for action in ('created', 'updated'):
+        if res[action]:
+            ret['changes'][action] = res[action]
+    if res['failed']:
+        ret['comment'] = '\n'.join('%s: %s' % (query, error) for query, error
+                                   in sorted(res['failed'].items()))
+    elif __opts__['test'] and ret['changes']:
+        ret['result'] = None
+        ret['comment'] = '%d queries would be uploaded' % (
+            len(res['created']) + len(res['updated']))
+    else:
+        ret['result'] = True
+        ret['comment'] = '%d queries uploaded, %d unchanged' % (
+            len(res['created']) + len(res['updated']), len(res['unchanged']))
+    return _summarize(ret, before, profile)
+
+
+# State functions merged by mod_aggregate: the part of the redash.sync tree
+# they map to and their comments when created, updated or left alone
+_AGGREGATE = {
+    'datasource_present': ('datasources', 'Datasource created',
+                           'Datasource was updated', 'Datasource is present'),
+    'user_present': ('users', 'User was created', 'User was updated',
+                     'User is present'),
+    'group_present': ('groups', 'Group was created', 'Group was updated',
+                      'Group is present and in the desired state'),
+    'query_present': ('queries', 'Query was created', 'Query was updated',
+                      'Query is present')
+}
+
+_REQUISITES = ('require', 'require_any', 'watch', 'watch_any', 'use')
+# Requisites that run a state only depending on the outcome of others, left
+# to Salt
+_CONDITIONAL_REQUISITES = ('prereq', 'prereq_in', 'onchanges',
+                           'onchanges_any', 'onfail', 'onfail_any',
+                           'onfail_all')
+
+
+# Key of a chunk in the tree handed to redash.sync
+def _aggregate_key(chunk):
+    if chunk['fun'] == 'user_present':
+        return chunk.get('email')
+    return chunk.get('name')
+
+
+# Whether the requisites of a chunk have all run successfully. Salt >= 3007
+# hands over only the chunks aggregated with low and keeps the others in
+# running; older releases hand over every chunk, including those still
+# waiting. Requisites this cannot resolve to a chunk of the run (sls, id,
+# globs, states defined elsewhere) count as not met, and chunks with
+# conditional requisites are never merged.
+def _requisites_met(chunk, chunks, running):
+    if chunk.get('onlyif') or chunk.get('unless') or \
+            chunk.get('check_cmd'):
+        return False
+    if any(chunk.get(requisite) for requisite in _CONDITIONAL_REQUISITES):
+        return False
+    # State, id and name of every known chunk, by tag
+    known = dict((tag, tag.split('_|-')[:3]) for tag in running)
+    for other in chunks:
+        known[__utils__['state.gen_tag'](other)] = [
+            other.get('state'), other.get('__id__'), other.get('name')]
+    for requisite in _REQUISITES:
+        for req in chunk.get(requisite) or []:
+            if not isinstance(req, dict):
+                return False
+            for state, ref in req.items():
+                if state in ('sls', 'id'):
+                    return False
+                tags = [tag for tag, (kind, id_, name) in known.items()
+                        if kind == state and ref in (id_, name)]
+                if not tags:
+                    return False
+                for tag in tags:
+                    if tag not in running or \
+                            running[tag].get('result') is not True:
+                        return False
+    return True
+
+
+# Desired properties of a chunk in the redash.sync tree
+def _aggregate_properties(chunk):
+    fun = chunk['fun']
+    if fun == 'datasource_present':
+        return {'type': chunk['type'], 'options': chunk['options']}
+    if fun == 'user_present':
+        return {'name': chunk['name']}
+    if fun == 'group_present':
+        return {'members': chunk.get('members') or [],
+                'datasources': chunk.get('datasources') or {}}
+    return {
+        'datasource': chunk['datasource'],
+        'description': chunk['description'],
+        'query': chunk['query'],
+        'options': chunk.get('options') or {},
+        'schedule': chunk.get('schedule'),
+        'publish': chunk.get('publish', True)
+    }
+
+
+def mod_aggregate(low, chunks, running):
+    '''
+    With ``state_aggregate`` enabled, merge the pending redash present states
+    into a single redash.sync call that reads every collection once. The
+    merged states then report the outcome computed for them.
+    '''
+    if low.get('fun') not in _AGGREGATE or __opts__['test']:
+        return low
+    if low.get('fun') == 'datasource_present' and low.get('force'):
+        return low
+    # Salt calls mod_aggregate before checking the requisites and the
+    # onlyif/unless of low itself
+    if not _requisites_met(low, chunks, running):
+        return low
+    # Only states against the same instance can be merged
+    profile = low.get('profile')
+    batch = [low]
+    low_tag = __utils__['state.gen_tag'](low)
+    for chunk in chunks:
+        if chunk.get('state') != 'redash' or \
+                chunk.get('fun') not in _AGGREGATE or \
+                chunk.get('__agg__') or chunk.get('force') or \
+                chunk.get('profile') != profile:
+            continue
+        tag = __utils__['state.gen_tag'](chunk)
+        if tag == low_tag or tag in running or \
+                not _requisites_met(chunk, chunks, running):
+            continue
+        batch.append(chunk)
+    if len(batch) < 2:
+        return low
+
+    tree = {}
+    for chunk in batch:
+        kind = _AGGREGATE[chunk['fun']][0]
+        tree.setdefault(kind, {})[_aggregate_key(chunk)] = \
+            _aggregate_properties(chunk)
+    # States left alone fail one by one when Redash cannot be called
+    if __salt__['redash.unavailable'](profile=profile) is not None:
+        return low
+    log.debug('Aggregating %d redash states' % len(batch))
+    try:
+        res = __salt__['redash.sync'](tree=tree, profile=profile)
+    except CommandExecutionError as exc:
+        log.error('Could not aggregate redash states: %s' % exc)
+        return low
+
+    results = __context__.setdefault('redash.aggregated', {})
+    for chunk in batch:
+        kind, created, updated, present = _AGGREGATE[chunk['fun']]
+        key = _aggregate_key(chunk)
+        chunk['__agg__'] = True
+        ret = {'name': key,
+               'changes': {},
+               'result': True,
+               'comment': present}
+        if key in res['failed'].get(kind, {}):
+            ret['result'] = False
+            ret['comment'] = res['failed'][kind][key]
+        elif key in res['changes'].get(kind, {}):
+            change = res['changes'][kind][key]
+            ret['changes'] = _changes(change['old'][key], change['new'][key])
+            ret['comment'] = created \
+                if change['old'][key] == 'Not present' else updated
+        results[(chunk['fun'], key, profile)] = ret
+    return low
+
+
+def stats_reported(name, fire_event=True, profile=None, **kwargs):
+    '''
+    Summarize the API requests made so far in this run, optionally firing
+    them as a ``redash/stats`` event. Meant to run last.
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+    res = __salt__['redash.stats'](fire_event=fire_event, profile=profile)
+    slowest = sorted(res['endpoints'].items(),
+                     key=lambda item: item[1]['time'], reverse=True)[:5]
+    lines = ['%d API requests in %.3fs, %d errors, %d bytes received as %d'
+             ' on the wire, %.3fs parsing JSON' %
+             (res['totals']['count'], res['totals']['time'],
+              res['totals']['errors'], res['totals']['bytes'],
+              res['totals']['wire_bytes'], res['totals']['parse_time'])]
+    for endpoint, details in slowest:
+        lines.append('%s: %d requests, %.3fs, p50 %.3fs, p95 %.3fs' %
+                     (endpoint, details['count'], details['time'],
+                      details['p50'], details['p95']))
+    ret['comment'] = '\n'.join(lines)
     return ret
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark the redash execution and state modules against the mock server.
+
+Every scenario runs with a cold ``__context__`` against a fresh dataset of
+the given size and reports the number of HTTP requests served, the wall
+time and the peak memory allocated while it ran::
+
+    python test/benchmark.py --sizes 10 100 1000 --latency 0.005
+
+With ``--check`` it runs the regression checks against the mock server
+instead.
+
+Salt and requests need to be installed; the modules are loaded from this
+formula through the regular Salt loader.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import salt.config
+import salt.loader
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_redash import Dataset, MockRedash  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = [10, 100, 1000, 10000]
+
+
+class Formula(object):
+    '''
+    The redash execution and state modules loaded through the Salt loader.
+    '''
+
+    def __init__(self, url, cachedir, config=None):
+        opts = salt.config.minion_config(None)
+        opts.update({
+            'file_client': 'local',
+            'cachedir': cachedir,
+            'module_dirs': [os.path.join(ROOT, '_modules')],
+            'states_dirs': [os.path.join(ROOT, '_states')],
+            'test': False,
+            'pillar': {
+                'redash': {
+                    'api_url': url,
+                    'api_key': 'benchmark'
+                }
+            }
+        })
+        opts['pillar']['redash'].update(config or {})
+        self.opts = opts
+        self.context = {}
+        utils = salt.loader.utils(opts)
+        self.functions = salt.loader.minion_mods(opts, context=self.context,
+                                                 utils=utils)
+        self.states = salt.loader.states(opts, self.functions, utils, {},
+                                         context=self.context)
+
+    def cold(self):
+        self.context.clear()
+
+
+def _dataset(size):
+    return Dataset(users=size, groups=max(1, size // 10),
+                   datasources=max(1, min(size // 10, 50)), queries=size)
+
+
+# Objects are numbered in creation order: the default group comes first and
+# the data sources right after it
+_FIRST_DATASOURCE_ID = 3
+
+
+def _tree(size):
+    '''
+    Return a ``redash`` pillar tree matching a dataset of ``size``, with one
+    user in ten renamed and one query in ten rewritten.
+    '''
+    datasources = max(1, min(size // 10, 50))
+    return {
+        'datasources': dict(
+            ('Datasource %d' % i,
+             {'type': 'pg',
+              'options': {'host': 'db%d' % i, 'port': 5432,
+                          'dbname': 'postgres', 'user': 'postgres'}})
+            for i in range(datasources)),
+        'users': dict(
+            ('user%d@example.com' % i,
+             {'name': 'User %d%s' % (i, ' renamed' if i % 10 == 0 else '')})
+            for i in range(size)),
+        'groups': {
+            'Group 0': {
+                'members': ['user%d@example.com' % i
+                            for i in range(min(size, 10))],
+                'datasources': {'Datasource 0': {'view_only': True}}
+            }
+        },
+        'queries': dict(
+            ('Query %d' % i,
+             {'datasource': 'Datasource %d' % (i % datasources),
+              'description': 'Benchmark query %d' % i,
+              'query': 'SELECT %d%s' % (i, ' + 1' if i % 10 == 0 else '')})
+            for i in range(size))
+    }
+
+
+def _module(function, **kwargs):
+    return lambda formula: formula.functions['redash.%s' % function](**kwargs)
+
+
+def _state(function, **kwargs):
+    return lambda formula: formula.states['redash.%s' % function](**kwargs)
+
+
+def scenarios(size):
+    '''
+    Return ``(name, callable(formula))`` pairs for a dataset of ``size``.
+    '''
+    last = size - 1
+    members = ['user%d@example.com' % i for i in range(min(size, 200))]
+    query = {
+        'name': 'Query %d' % last,
+        'datasource': 'Datasource 0',
+        'description': 'Benchmark query %d' % last,
+        'query': 'SELECT 1',
+    }
+    options = {'host': 'db0', 'port': 5432, 'dbname': 'postgres',
+               'user': 'postgres'}
+    tree = _tree(size)
+    uploads = dict(('Uploaded query %d' % i,
+                    {'datasource': 'Datasource 0', 'description': 'New',
+                     'query': 'SELECT %d' % i})
+                   for i in range(min(size, 100)))
+    return [
+        ('redash.list_users', _module('list_users')),
+        ('redash.list_users email',
+         _module('list_users', email='user%d@example.com' % last)),
+        ('redash.list_groups', _module('list_groups')),
+        ('redash.list_groups name', _module('list_groups', name='Group 0')),
+        ('redash.list_datasources', _module('list_datasources')),
+        ('redash.list_datasources name',
+         _module('list_datasources', name='Datasource 0')),
+        ('redash.list_queries', _module('list_queries')),
+        ('redash.list_queries name',
+         _module('list_queries', name='Query %d' % last)),
+        ('redash.add_user',
+         _module('add_user', email='new@example.com', name='New user')),
+        ('redash.alter_user',
+         _module('alter_user', email='user%d@example.com' % last,
+                 name='Renamed')),
+        ('redash.add_datasource',
+         _module('add_datasource', name='New datasource', type='pg',
+                 options=options)),
+        ('redash.alter_datasource',
+         _module('alter_datasource', id=_FIRST_DATASOURCE_ID,
+                 name='Datasource 0', type='pg',
+                 options=dict(options, port=5433))),
+        ('redash.remove_datasource',
+         _module('remove_datasource', name='Datasource 0')),
+        ('redash.add_query',
+         _module('add_query', name='New query', datasource='Datasource 0',
+                 description='New', query='SELECT 1')),
+        ('redash.alter_query', _module('alter_query', **query)),
+        ('redash.query_matches', _module('query_matches', **query)),
+        ('redash.archive_query',
+         _module('archive_query', name='Query %d' % last)),
+        ('redash.upload_queries',
+         _module('upload_queries', queries=uploads, source='benchmark')),
+        ('redash.refresh_queries',
+         _module('refresh_queries', names=['Query 0'])),
+        ('redash.add_group', _module('add_group', name='New group')),
+        ('redash.remove_group', _module('remove_group', name='Group 0')),
+        ('redash.add_group_member',
+         _module('add_group_member', name='Group 0',
+                 member='user%d@example.com' % last)),
+        ('redash.remove_group_member',
+         _module('remove_group_member', name='Group 0',
+                 member='user0@example.com')),
+        ('redash.set_group_members',
+         _module('set_group_members', name='Group 0', members=members)),
+        ('redash.alter_group_datasource',
+         _module('alter_group_datasource', name='Group 0',
+                 datasource='Datasource 0', view_only=False)),
+        ('redash.remove_group_datasource',
+         _module('remove_group_datasource', name='Group 0',
+                 datasource='Datasource 0')),
+        ('redash.set_group_datasources',
+         _module('set_group_datasources', name='Group 0',
+                 datasources={'Datasource 0': {'view_only': False}})),
+        ('redash.sync', _module('sync', tree=tree)),
+        ('redash.sync test', _module('sync', tree=tree, test=True)),
+        ('redash.drift', _module('drift', tree=tree)),
+        ('redash.user_present',
+         _state('user_present', email='user%d@example.com' % last,
+                name='Renamed')),
+        ('redash.group_present',
+         _state('group_present', name='Group 0', members=members,
+                datasources={'Datasource 0': None})),
+        ('redash.group_absent', _state('group_absent', name='Group 0')),
+        ('redash.datasource_present',
+         _state('datasource_present', name='Datasource 0', type='pg',
+                options=options)),
+        ('redash.datasource_absent',
+         _state('datasource_absent', name='Datasource 0')),
+        ('redash.query_present', _state('query_present', **query)),
+        ('redash.query_present create',
+         _state('query_present', name='Created query',
+                datasource='Datasource 0', description='New',
+                query='SELECT 2')),
+        ('redash.managed', _state('managed', name='redash', tree=tree)),
+    ]
+
+
+def _edited_query_is_changed(formula, server):
+    '''
+    A query edited on the server after it was applied is no longer reported
+    as unchanged by the incremental store.
+    '''
+    functions = formula.functions
+    functions['redash.remember_query'](name='Query 0', digest='applied')
+    qid = [query['id'] for query in server.dataset.queries.values()
+           if query['name'] == 'Query 0'][0]
+    server.dataset.update_query(qid, {'query': 'SELECT 42'})
+    formula.cold()
+    assert not functions['redash.query_unchanged'](name='Query 0',
+                                                   digest='applied'), \
+        'the edit of Query 0 went unnoticed'
+
+
+def _edited_query_drifts(formula, server):
+    '''
+    drift, and so the beacon, reports a query edited on the server between
+    two polls.
+    '''
+    tree = {'queries': {'Query 0': {'datasource': 'Datasource 0',
+                                    'description': 'Benchmark query 0',
+                                    'query': 'SELECT 0',
+                                    'publish': False}}}
+    drift = formula.functions['redash.drift']
+    assert drift(tree=tree)['queries'] == {}, 'Query 0 drifted already'
+    qid = [query['id'] for query in server.dataset.queries.values()
+           if query['name'] == 'Query 0'][0]
+    server.dataset.update_query(qid, {'query': 'SELECT 42'})
+    assert 'Query 0' in drift(tree=tree)['queries'], \
+        'the edit of Query 0 went unnoticed'
+
+
+def checks():
+    '''
+    Return ``(name, mock server options, callable(formula, server))``
+    regression checks, which raise AssertionError when they fail.
+    '''
+    return [
+        ('query store, ordered listing', {}, _edited_query_is_changed),
+        ('query store, unordered listing', {'ordering': False},
+         _edited_query_is_changed),
+        ('drift, ordered listing', {}, _edited_query_drifts),
+        ('drift, unordered listing', {'ordering': False},
+         _edited_query_drifts),
+    ]
+
+
+def run_checks(config=None):
+    failures = 0
+    for name, options, function in checks():
+        # Every check gets a pristine instance and minion cache
+        cachedir = tempfile.mkdtemp(prefix='redash-checks-')
+        server = MockRedash(dataset=_dataset(10), **options)
+        server.start()
+        try:
+            function(Formula(server.url, cachedir, config), server)
+            print('%-40s ok' % name)
+        except AssertionError as exc:
+            failures = failures + 1
+            print('%-40s FAILED: %s' % (name, exc))
+        finally:
+            server.stop()
+            shutil.rmtree(cachedir, ignore_errors=True)
+    return failures
+
+
+def measure(formula, server, function):
+    formula.cold()
+    server.reset_counters()
+    tracemalloc.start()
+    start = time.time()
+    error = None
+    try:
+        function(formula)
+    except Exception as exc:
+        error = '%s: %s' % (exc.__class__.__name__, exc)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'requests': server.total_requests(),
+        'wall': elapsed,
+        'peak_kib': peak // 1024,
+        'error': error
+    }
+
+
+def run(sizes, latency, only=None, config=None, gzip=False):
+    results = []
+    cachedir = tempfile.mkdtemp(prefix='redash-benchmark-')
+    try:
+        for size in sizes:
+            for name, function in scenarios(size):
+                if only and only not in name:
+                    continue
+                # Every scenario gets a pristine instance
+                server = MockRedash(dataset=_dataset(size), latency=latency,
+                                    gzip=gzip)
+                server.start()
+                try:
+                    formula = Formula(server.url, cachedir, config)
+                    result = measure(formula, server, function)
+                finally:
+                    server.stop()
+                result.update({'name': name, 'size': size})
+                results.append(result)
+                print('%-34s %6d %9d %9.3fs %9d KiB %s' % (
+                    name, size, result['requests'], result['wall'],
+                    result['peak_kib'], result['error'] or ''))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(cachedir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    parser.add_argument('--only', help='run scenarios containing this text')
+    parser.add_argument('--engine', choices=['sync', 'async'],
+                        help='redash:engine used for fan-out requests')
+    parser.add_argument('--gzip', action='store_true',
+                        help='compress the responses of the mock server')
+    parser.add_argument('--codec', choices=['json', 'ujson', 'orjson'],
+                        help='redash:json_codec')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--check', action='store_true',
+                        help='run the regression checks instead')
+    args = parser.parse_args()
+    config = {}
+    if args.engine:
+        config['engine'] = args.engine
+    if args.codec:
+        config['json_codec'] = args.codec
+    if args.check:
+        sys.exit(1 if run_checks(config) else 0)
+    print('%-34s %6s %9s %10s %13s' % ('scenario', 'size', 'requests',
+                                       'wall', 'peak memory'))
+    results = run(args.sizes, args.latency, args.only, config, args.gzip)
+    if args.json:
+        with open(args.json, 'w') as handle:
+            json.dump(results, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,652 @@
+# -*- coding: utf-8 -*-
+'''
+Offline stand-in for the Redash REST API.
+
+Implements the subset of endpoints used by ``_modules/redash.py``: users,
+groups, group members and data sources, data sources, queries, query
+refreshes, jobs and query results. Collections are paginated the way Redash
+does it and errors come back as ``{"message": ...}`` with a 4xx status.
+Refresh jobs stay running for ``job_duration`` seconds and produce results
+of ``result_rows`` rows. With ``gzip`` responses are compressed for clients
+that accept it. With ``etags`` JSON responses carry an ``ETag`` and
+conditional requests for an unchanged body get a 304. Without ``ordering``
+the query listing ignores ``order``, as real Redash does.
+
+Run it standalone with::
+
+    python test/mock_redash.py --port 5000 --users 100 --latency 0.01
+'''
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat() + 'Z'
+
+
+class Dataset(object):
+    '''
+    In-memory Redash state.
+    '''
+
+    def __init__(self, users=0, groups=0, datasources=0, queries=0,
+                 members_per_group=5):
+        self.lock = threading.RLock()
+        self.next_id = 1
+        self.users = {}
+        self.groups = {}
+        self.members = {}
+        self.group_ds = {}
+        self.datasources = {}
+        self.queries = {}
+        self.jobs = {}
+        self.results = {}
+        self.populate(users, groups, datasources, queries, members_per_group)
+
+    def _id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def populate(self, users, groups, datasources, queries,
+                 members_per_group):
+        default = self.add_group('default')
+        for i in range(datasources):
+            ds = self.add_datasource('Datasource %d' % i, 'pg',
+                                     {'host': 'db%d' % i, 'port': 5432,
+                                      'dbname': 'postgres',
+                                      'user': 'postgres'})
+            self.group_ds[default['id']][ds['id']] = False
+        user_ids = []
+        for i in range(users):
+            user = self.add_user('user%d@example.com' % i, 'User %d' % i)
+            user_ids.append(user['id'])
+        ds_ids = sorted(self.datasources)
+        for i in range(groups):
+            group = self.add_group('Group %d' % i)
+            for j in range(min(members_per_group, len(user_ids))):
+                uid = user_ids[(i * members_per_group + j) % len(user_ids)]
+                self.members[group['id']].add(uid)
+            if ds_ids:
+                self.group_ds[group['id']][ds_ids[i % len(ds_ids)]] = True
+        for i in range(queries):
+            self.add_query({
+                'name': 'Query %d' % i,
+                'description': 'Benchmark query %d' % i,
+                'query': 'SELECT %d' % i,
+                'data_source_id': ds_ids[i % len(ds_ids)] if ds_ids else None,
+                'options': {},
+                'schedule': None,
+            })
+
+    # Users
+    def add_user(self, email, name):
+        uid = self._id()
+        self.users[uid] = {'id': uid, 'email': email, 'name': name,
+                           'updated_at': _now()}
+        return self.user(uid)
+
+    def user(self, uid):
+        user = dict(self.users[uid])
+        user['groups'] = sorted(gid for gid, members in self.members.items()
+                                if uid in members)
+        return user
+
+    # Groups
+    def add_group(self, name):
+        gid = self._id()
+        self.groups[gid] = {'id': gid, 'name': name, 'type': 'regular',
+                            'permissions': []}
+        self.members[gid] = set()
+        self.group_ds[gid] = {}
+        return dict(self.groups[gid])
+
+    # Data sources
+    def add_datasource(self, name, type, options):
+        dsid = self._id()
+        self.datasources[dsid] = {'id': dsid, 'name': name, 'type': type,
+                                  'options': options, 'syntax': 'sql',
+                                  'paused': 0, 'view_only': False}
+        return self.datasource(dsid)
+
+    def datasource(self, dsid):
+        ds = dict(self.datasources[dsid])
+        ds['groups'] = dict((str(gid), grants[dsid])
+                            for gid, grants in self.group_ds.items()
+                            if dsid in grants)
+        return ds
+
+    # Queries
+    def add_query(self, data):
+        qid = self._id()
+        query = {
+            'id': qid,
+            'name': data.get('name'),
+            'description': data.get('description'),
+            'query': data.get('query'),
+            'data_source_id': data.get('data_source_id'),
+            'options': data.get('options') or {},
+            'schedule': data.get('schedule'),
+            'is_draft': True,
+            'is_archived': False,
+            'latest_query_data_id': None,
+            'created_at': _now(),
+            'updated_at': _now(),
+            'version': 1,
+        }
+        self.queries[qid] = query
+        return dict(query)
+
+    def update_query(self, qid, data):
+        query = self.queries[qid]
+        for key in ('name', 'description', 'query', 'data_source_id',
+                    'options', 'schedule', 'is_draft'):
+            if key in data:
+                query[key] = data[key]
+        query['updated_at'] = _now()
+        query['version'] += 1
+        return dict(query)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send every response in one segment, so that the measured wall time is
+    # not dominated by delayed ACKs.
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def data(self):
+        return self.server.dataset
+
+    def _reply(self, status, body=None, raw=None, content_type=None):
+        if raw is None:
+            raw = json.dumps(body).encode('utf-8') if body is not None \
+                else b''
+            content_type = content_type or 'application/json'
+            if self.server.etags and status == 200 and \
+                    self.command == 'GET':
+                etag = '"%s"' % hashlib.sha1(raw).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    status, raw, content_type = 304, b'', None
+                self.etag = etag
+        self.send_response(status)
+        if getattr(self, 'etag', None):
+            self.send_header('ETag', self.etag)
+            self.etag = None
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if raw and self.server.gzip and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            raw = gzip.compress(raw)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+        self.server.count(self.command, self.path, status)
+
+    def _error(self, status, message):
+        self._reply(status, {'message': message})
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        raw = self.rfile.read(length)
+        try:
+            return json.loads(raw.decode('utf-8')) or {}
+        except ValueError:
+            return {}
+
+    def _route(self, method):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        path = url.path
+        if path.startswith('/api/'):
+            path = path[len('/api/'):]
+        path = path.strip('/')
+        body = self._body() if method == 'POST' else {}
+        with self.data.lock:
+            for pattern, handler in ROUTES.get(method, []):
+                match = re.match('^%s$' % pattern, path)
+                if match:
+                    args = [int(a) if a.isdigit() else a
+                            for a in match.groups()]
+                    return handler(self, params, body, *args)
+        self._error(404, 'Not found: %s %s' % (method, path))
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+    # Helpers
+    def _paginate(self, items, params):
+        page = int(params.get('page', 1))
+        page_size = min(int(params.get('page_size', 25)),
+                        self.server.max_page_size)
+        start = (page - 1) * page_size
+        self._reply(200, {
+            'count': len(items),
+            'page': page,
+            'page_size': page_size,
+            'results': items[start:start + page_size]
+        })
+
+    # Users
+    def list_users(self, params, body):
+        users = [self.data.user(uid) for uid in sorted(self.data.users)]
+        q = params.get('q')
+        if q and self.server.search:
+            q = q.lower()
+            users = [u for u in users
+                     if q in u['email'].lower() or q in u['name'].lower()]
+        self._paginate(users, params)
+
+    def get_user(self, params, body, uid):
+        if uid not in self.data.users:
+            return self._error(404, 'User not found')
+        self._reply(200, self.data.user(uid))
+
+    def create_user(self, params, body):
+        for user in self.data.users.values():
+            if user['email'] == body.get('email'):
+                return self._error(400, 'Email already taken')
+        self._reply(200, self.data.add_user(body.get('email'),
+                                            body.get('name')))
+
+    def update_user(self, params, body, uid):
+        if uid not in self.data.users:
+            return self._error(404, 'User not found')
+        for key in ('name', 'email'):
+            if key in body:
+                self.data.users[uid][key] = body[key]
+        self.data.users[uid]['updated_at'] = _now()
+        self._reply(200, self.data.user(uid))
+
+    # Groups
+    def list_groups(self, params, body):
+        self._reply(200, [dict(self.data.groups[gid])
+                          for gid in sorted(self.data.groups)])
+
+    def get_group(self, params, body, gid):
+        if gid not in self.data.groups:
+            return self._error(404, 'Group not found')
+        self._reply(200, dict(self.data.groups[gid]))
+
+    def create_group(self, params, body):
+        self._reply(200, self.data.add_group(body.get('name')))
+
+    def delete_group(self, params, body, gid):
+        if gid not in self.data.groups:
+            return self._error(404, 'Group not found')
+        del self.data.groups[gid]
+        del self.data.group_ds[gid]
+        # Redash keeps lingering memberships around after removing a group
+        self._reply(204)
+
+    def list_members(self, params, body, gid):
+        if gid not in self.data.groups:
+            return self._error(404, 'Group not found')
+        self._reply(200, [self.data.user(uid)
+                          for uid in sorted(self.data.members[gid])])
+
+    def add_member(self, params, body, gid):
+        if gid not in self.data.groups:
+            return self._error(404, 'Group not found')
+        uid = body.get('user_id')
+        if uid not in self.data.users:
+            return self._error(404, 'User not found')
+        self.data.members[gid].add(uid)
+        self._reply(200, self.data.user(uid))
+
+    def remove_member(self, params, body, gid, uid):
+        if gid not in self.data.groups:
+            return self._error(404, 'Group not found')
+        self.data.members[gid].discard(uid)
+        self._reply(200, {})
+
+    def list_group_ds(self, params, body, gid):
+        if gid not in self.data.groups:
+            return self._error(404, 'Group not found')
+        result = []
+        for dsid, view_only in sorted(self.data.group_ds[gid].items()):
+            ds = dict(self.data.datasources[dsid])
+            ds.pop('options', None)
+            ds['view_only'] = view_only
+            result.append(ds)
+        self._reply(200, result)
+
+    def add_group_ds(self, params, body, gid):
+        if gid not in self.data.groups:
+            return self._error(404, 'Group not found')
+        dsid = body.get('data_source_id')
+        if dsid not in self.data.datasources:
+            return self._error(404, 'Data source not found')
+        self.data.group_ds[gid][dsid] = False
+        self._reply(200, self.data.datasource(dsid))
+
+    def alter_group_ds(self, params, body, gid, dsid):
+        if gid not in self.data.groups or \
+                dsid not in self.data.group_ds[gid]:
+            return self._error(404, 'Not found')
+        self.data.group_ds[gid][dsid] = bool(body.get('view_only'))
+        self._reply(200, self.data.datasource(dsid))
+
+    def remove_group_ds(self, params, body, gid, dsid):
+        if gid not in self.data.groups:
+            return self._error(404, 'Group not found')
+        self.data.group_ds[gid].pop(dsid, None)
+        self._reply(200, {})
+
+    # Data sources
+    def list_ds(self, params, body):
+        result = []
+        for dsid in sorted(self.data.datasources):
+            ds = dict(self.data.datasources[dsid])
+            ds.pop('options', None)
+            result.append(ds)
+        self._reply(200, result)
+
+    def get_ds(self, params, body, dsid):
+        if dsid not in self.data.datasources:
+            return self._error(404, 'Data source not found')
+        self._reply(200, self.data.datasource(dsid))
+
+    def create_ds(self, params, body):
+        for ds in self.data.datasources.values():
+            if ds['name'] == body.get('name'):
+                return self._error(400, 'Data source already exists')
+        ds = self.data.add_datasource(body.get('name'), body.get('type'),
+                                      body.get('options') or {})
+        self._reply(200, ds)
+
+    def update_ds(self, params, body, dsid):
+        if dsid not in self.data.datasources:
+            return self._error(404, 'Data source not found')
+        for key in ('name', 'type', 'options'):
+            if key in body:
+                self.data.datasources[dsid][key] = body[key]
+        self._reply(200, self.data.datasource(dsid))
+
+    def delete_ds(self, params, body, dsid):
+        if dsid not in self.data.datasources:
+            return self._error(404, 'Data source not found')
+        del self.data.datasources[dsid]
+        for grants in self.data.group_ds.values():
+            grants.pop(dsid, None)
+        self._reply(204)
+
+    # Queries
+    def _live_queries(self):
+        return [dict(q) for q in self.data.queries.values()
+                if not q['is_archived']]
+
+    def list_queries(self, params, body):
+        queries = self._live_queries()
+        # Real Redash ignores the order parameter of the query listing
+        order = params.get('order', 'created_at') if self.server.ordering \
+            else 'created_at'
+        reverse = order.startswith('-')
+        key = order.lstrip('-')
+        if key not in ('created_at', 'updated_at', 'name', 'id'):
+            key = 'id'
+        queries.sort(key=lambda q: (q[key], q['id']), reverse=reverse)
+        q = params.get('q')
+        if q and self.server.search:
+            queries = [query for query in queries
+                       if q.lower() in query['name'].lower()]
+        self._paginate(queries, params)
+
+    def search_queries(self, params, body):
+        if not self.server.search:
+            return self._error(404, 'Not found')
+        q = params.get('q', '').lower()
+        self._reply(200, [query for query in self._live_queries()
+                          if q in query['name'].lower()])
+
+    def get_query(self, params, body, qid):
+        query = self.data.queries.get(qid)
+        if query is None or query['is_archived']:
+            return self._error(404, 'Query not found')
+        self._reply(200, dict(query))
+
+    def create_query(self, params, body):
+        if body.get('data_source_id') not in self.data.datasources:
+            return self._error(400, 'Invalid data source')
+        self._reply(200, self.data.add_query(body))
+
+    def update_query(self, params, body, qid):
+        query = self.data.queries.get(qid)
+        if query is None or query['is_archived']:
+            return self._error(404, 'Query not found')
+        self._reply(200, self.data.update_query(qid, body))
+
+    def archive_query(self, params, body, qid):
+        query = self.data.queries.get(qid)
+        if query is None or query['is_archived']:
+            return self._error(404, 'Query not found')
+        query['is_archived'] = True
+        query['updated_at'] = _now()
+        self._reply(200, {})
+
+    def refresh_query(self, params, body, qid):
+        query = self.data.queries.get(qid)
+        if query is None or query['is_archived']:
+            return self._error(404, 'Query not found')
+        job_id = 'job-%d' % self.data._id()
+        self.data.jobs[job_id] = {'id': job_id, 'query': qid,
+                                  'started': time.time()}
+        self._reply(200, {'job': {'id': job_id, 'status': 1,
+                                  'error': '', 'query_result_id': None}})
+
+    def get_job(self, params, body, job_id):
+        job = self.data.jobs.get(job_id)
+        if job is None:
+            return self._error(404, 'Job not found')
+        if time.time() - job['started'] < self.server.job_duration:
+            return self._reply(200, {'job': {'id': job_id, 'status': 2,
+                                             'error': '',
+                                             'query_result_id': None}})
+        result_id = job.get('result')
+        if result_id is None:
+            result_id = self.data._id()
+            query = self.data.queries[job['query']]
+            rows = [{'id': i, 'value': 'row %d' % i}
+                    for i in range(self.server.result_rows)]
+            self.data.results[result_id] = {
+                'id': result_id,
+                'query': query['query'],
+                'data': {'columns': [{'name': 'id', 'type': 'integer'},
+                                     {'name': 'value', 'type': 'string'}],
+                         'rows': rows},
+                'retrieved_at': _now(),
+                'runtime': 0.01,
+            }
+            query['latest_query_data_id'] = result_id
+            job['result'] = result_id
+        self._reply(200, {'job': {'id': job_id, 'status': 3, 'error': '',
+                                  'query_result_id': result_id}})
+
+    def _result(self, result_id, fmt):
+        result = self.data.results.get(result_id)
+        if result is None:
+            return self._error(404, 'Query result not found')
+        if fmt == 'csv':
+            columns = [c['name'] for c in result['data']['columns']]
+            lines = [','.join(columns)]
+            for row in result['data']['rows']:
+                lines.append(','.join(str(row[c]) for c in columns))
+            raw = ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+            return self._reply(200, raw=raw, content_type='text/csv')
+        self._reply(200, {'query_result': result})
+
+    def query_result(self, params, body, qid, fmt):
+        query = self.data.queries.get(qid)
+        if query is None or not query['latest_query_data_id']:
+            return self._error(404, 'No cached result found')
+        self._result(query['latest_query_data_id'], fmt)
+
+    def query_result_by_id(self, params, body, qid, result_id, fmt):
+        self._result(result_id, fmt)
+
+    def plain_result(self, params, body, result_id, fmt):
+        self._result(result_id, fmt)
+
+    # Leftovers
+    def empty_list(self, params, body):
+        self._reply(200, [])
+
+
+ROUTES = {
+    'GET': [
+        (r'users', Handler.list_users),
+        (r'users/(\d+)', Handler.get_user),
+        (r'groups', Handler.list_groups),
+        (r'groups/(\d+)', Handler.get_group),
+        (r'groups/(\d+)/members', Handler.list_members),
+        (r'groups/(\d+)/data_sources', Handler.list_group_ds),
+        (r'data_sources', Handler.list_ds),
+        (r'data_sources/(\d+)', Handler.get_ds),
+        (r'queries', Handler.list_queries),
+        (r'queries/search', Handler.search_queries),
+        (r'queries/(\d+)', Handler.get_query),
+        (r'queries/(\d+)/results\.(json|csv)', Handler.query_result),
+        (r'queries/(\d+)/results/(\d+)\.(json|csv)',
+         Handler.query_result_by_id),
+        (r'query_results/(\d+)\.(json|csv)', Handler.plain_result),
+        (r'jobs/([\w-]+)', Handler.get_job),
+        (r'dashboards', Handler.empty_list),
+        (r'alerts', Handler.empty_list),
+    ],
+    'POST': [
+        (r'users', Handler.create_user),
+        (r'users/(\d+)', Handler.update_user),
+        (r'groups', Handler.create_group),
+        (r'groups/(\d+)/members', Handler.add_member),
+        (r'groups/(\d+)/data_sources', Handler.add_group_ds),
+        (r'groups/(\d+)/data_sources/(\d+)', Handler.alter_group_ds),
+        (r'data_sources', Handler.create_ds),
+        (r'data_sources/(\d+)', Handler.update_ds),
+        (r'queries', Handler.create_query),
+        (r'queries/(\d+)', Handler.update_query),
+        (r'queries/(\d+)/refresh', Handler.refresh_query),
+    ],
+    'DELETE': [
+        (r'groups/(\d+)', Handler.delete_group),
+        (r'groups/(\d+)/members/(\d+)', Handler.remove_member),
+        (r'groups/(\d+)/data_sources/(\d+)', Handler.remove_group_ds),
+        (r'data_sources/(\d+)', Handler.delete_ds),
+        (r'queries/(\d+)', Handler.archive_query),
+    ],
+}
+
+
+class MockRedash(ThreadingMixIn, HTTPServer):
+    '''
+    Threaded HTTP server serving a :class:`Dataset`.
+
+    ``requests`` counts every request served, per method and path template.
+    '''
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, dataset=None, latency=0.0, search=True,
+                 max_page_size=250, job_duration=0.0, result_rows=10,
+                 gzip=False, etags=False, ordering=True):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.dataset = dataset or Dataset()
+        self.latency = latency
+        self.search = search
+        self.max_page_size = max_page_size
+        self.job_duration = job_duration
+        self.result_rows = result_rows
+        self.gzip = gzip
+        self.etags = etags
+        self.ordering = ordering
+        self.requests = {}
+        self.stats_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/api' % self.server_address[1]
+
+    def count(self, method, path, status):
+        template = re.sub(r'/(job-)?\d+', '/{id}', urlparse(path).path)
+        key = '%s %s' % (method, template)
+        with self.stats_lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def total_requests(self):
+        with self.stats_lock:
+            return sum(self.requests.values())
+
+    def reset_counters(self):
+        with self.stats_lock:
+            self.requests = {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--groups', type=int, default=3)
+    parser.add_argument('--datasources', type=int, default=3)
+    parser.add_argument('--queries', type=int, default=10)
+    parser.add_argument('--no-search', action='store_true')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--etags', action='store_true')
+    parser.add_argument('--no-ordering', action='store_true')
+    args = parser.parse_args()
+    dataset = Dataset(users=args.users, groups=args.groups,
+                      datasources=args.datasources, queries=args.queries)
+    server = MockRedash(port=args.port, dataset=dataset,
+                        latency=args.latency, search=not args.no_search,
+                        gzip=args.gzip, etags=args.etags,
+                        ordering=not args.no_ordering)
+    print('Serving mock Redash API on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
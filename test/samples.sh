@@ -63,3 +63,54 @@ salt-call -l debug redash.add_user email='test4@test.com' name='Test User 4'
 ## Updating a user
 salt-call -l debug redash.alter_user email='test4@test.com' name='New Name 4'
 
+
+## Checking how many connections were reused by the HTTP client
+salt-call redash.pool_stats
+
+## Inspecting and clearing the lookup cache
+salt-call redash.cache_stats
+salt-call redash.clear_cache
+
+## Reconciling the whole instance against the redash pillar
+salt-call redash.sync test=True
+salt-call redash.sync
+
+## Setting the whole member list and data source grants of a group at once
+salt-call -l debug redash.set_group_members name='Test Group' members='["test@test.com", "test2@test2.com"]'
+salt-call -l debug redash.set_group_datasources name='Test Group' datasources='{"Internal Redash PostgreSQL": {"view_only": True}}'
+
+## Per-endpoint request counts and latencies of the current run
+salt-call redash.stats
+
+## Dropping the persistent snapshots of users, groups, datasources and queries
+salt-call redash.clear_snapshots
+
+## Queries changed since the previous run or a given time
+salt-call redash.list_changed_queries
+salt-call redash.list_changed_queries since='2026-01-01T00:00:00'
+
+## Comparing a query definition with the server by fingerprint
+salt-call redash.query_matches name='Test query' datasource='Test datasource' description='Test' query='SELECT 1'
+
+## Refreshing queries by name, name prefix or data source
+salt-call redash.refresh_queries names='["Test query"]'
+salt-call redash.refresh_queries prefix='Daily' concurrency=8 per_datasource=2
+salt-call redash.refresh_queries datasource='Test datasource' test=True
+
+## Streaming the latest result of a query to a file
+salt-call redash.fetch_query_result 'Test query' /tmp/test-query.csv
+salt-call redash.fetch_query_result 'Test query' /tmp/test-query.json.gz format=json compress=True
+
+## Rows of the latest result of a query, as served by the ext_pillar
+salt-call redash.get_query_result 'Test query'
+
+## Managed queries and data sources changed on the server
+salt-call redash.drift
+
+## Working against another instance from redash:profiles
+salt-call redash.list_users profile=eu
+salt-call redash.sync_profiles profiles='["eu", "us"]' test=True
+
+## Uploading a directory of .sql files, only those changed since last time
+salt-call state.single redash.queries_from_dir salt://redash/queries datasource='Test datasource' test=True
+salt-call redash.upload_queries queries='{"Test query": {"datasource": "Test datasource", "query": "SELECT 1"}}'